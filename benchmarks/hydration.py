@@ -0,0 +1,70 @@
+## per document cost of validated vs trusted hydration of stored documents
+##   python -m benchmarks.hydration [n_docs]
+import sys
+import timeit
+from datetime import datetime, timezone
+
+from models import IOCFinding, GeoLocation, ASN, Network, Organization
+
+NOW = datetime.now(timezone.utc)
+
+DOCS = {
+    IOCFinding: {
+        "_id": "65e7a1f0c2a4b1d2e3f40516",
+        "id": "4b8e2c1a-0f4e-4b7a-9c1d-2e3f4a5b6c7d",
+        "source": "https://cybercrime-tracker.net/all.php",
+        "source_ref": {"key": "cybercrime-tracker.net", "type": "FEED"},
+        "ioc_types": ["DOMAIN", "IPV4"],
+        "keys": {"DOMAIN": [f"host{i}.example.com" for i in range(20)], "IPV4": ["1.2.3.4"]},
+        "meta": {"ransomware_group": None, "date": NOW},
+        "created_at": NOW,
+    },
+    GeoLocation: {
+        "ipv4": "1.2.0.0",
+        "location": {"latitude": 12.97, "longitude": 77.59},
+        "country": {"names": {"en": "India", "de": "Indien", "fr": "Inde"}},
+        "continent": {"names": {"en": "Asia", "de": "Asien"}},
+        "city": {"names": {"en": "Bengaluru"}},
+        "subdivisions": [{"names": {"en": "Karnataka"}}],
+    },
+    ASN: {
+        "asn": "AS13335",
+        "organization_name": "Cloudflare, Inc.",
+        "domain_name": "cloudflare.com",
+        "entity_type": "hosting",
+        "tor": False,
+        "proxy": False,
+        "vpn": False,
+        "hosting": True,
+        "relay": False,
+        "service": False,
+    },
+    Network: {
+        "id": "0b6f3c9e-8d2a-4c1b-9e7f-5a4d3c2b1a09",
+        "host_addr": "10.20.0.0/16",
+        "broadcast_addr": "10.20.255.255",
+        "network_addr": "10.20.0.0",
+        "netmask": "255.255.0.0",
+        "host_mask": "0.0.255.255",
+        "network_st": "169082880",
+        "network_en": "169148415",
+        "ip_version": 4,
+        "range_st": 169082880,
+        "range_en": 169148415,
+        "prefixlen": 16,
+        "belongs_to": {"id": "org-1", "name": "Example Org"},
+    },
+    Organization: {"id": "org-1", "name": "Example Org", "voip_ports": [5060, 5061]},
+}
+
+
+def main(n_docs: int = 10000):
+    print(f"{'model':<14}{'validated us/doc':>18}{'trusted us/doc':>16}{'speedup':>9}")
+    for model, doc in DOCS.items():
+        validated = timeit.timeit(lambda: model(doc), number=n_docs) / n_docs * 1e6
+        trusted = timeit.timeit(lambda: model.from_trusted(doc), number=n_docs) / n_docs * 1e6
+        print(f"{model.__name__:<14}{validated:>18.2f}{trusted:>16.2f}{validated / trusted:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
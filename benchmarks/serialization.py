@@ -0,0 +1,50 @@
+## serialization cost of a listing page, fastapi's path (json_serializer,
+## then jsonable_encoder and json.dumps) against the single pass orjson path
+##   python -m benchmarks.serialization [page_size] [repeat]
+import sys
+import json
+import uuid
+import timeit
+from datetime import datetime, timezone
+
+from fastapi.encoders import jsonable_encoder
+
+from models import IOCFinding
+from models.sqlalch import NetFlow
+from utils import json_serializer, json_dumps
+from .hydration import DOCS
+
+NOW = datetime.now(timezone.utc)
+
+
+def ioc_page(page_size: int):
+    return {
+        "data": [IOCFinding.from_trusted(DOCS[IOCFinding]) for _ in range(page_size)],
+        "total_results": page_size,
+        "page_no": 1,
+    }
+
+
+def netflow_page(page_size: int):
+    row = {c.name: "1024" for c in NetFlow.__table__.columns}
+    return {
+        "data": [NetFlow(**{**row, "id": uuid.uuid4()}) for _ in range(page_size)],
+        "total_results": page_size,
+        "page_no": 1,
+    }
+
+
+def fastapi_path(page):
+    return json.dumps(jsonable_encoder(json_serializer(page))).encode("utf-8")
+
+
+def main(page_size: int = 1000, repeat: int = 20):
+    print(f"{'page':<10}{'fastapi ms':>12}{'orjson ms':>11}{'speedup':>9}")
+    for name, page in (("iocs", ioc_page(page_size)), ("netflow", netflow_page(page_size))):
+        before = timeit.timeit(lambda: fastapi_path(page), number=repeat) / repeat * 1e3
+        after = timeit.timeit(lambda: json_dumps(page), number=repeat) / repeat * 1e3
+        print(f"{name:<10}{before:>12.2f}{after:>11.2f}{before / after:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
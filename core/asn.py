@@ -1,5 +1,12 @@
+import os
+from typing import Any, Dict, Iterable, List, Tuple
+
 from database import AppDB
 from models import ASN
+from globals_ import env
+from .geo import prefix
+from .snapshot import N_SLOTS, Snapshot, SnapshotHandle, SnapshotWriter
+from .cache import MISSING, TTLCache
 
 ASN_PROJECTION = lambda: [
     {
@@ -86,12 +93,131 @@ ASN_PROJECTION = lambda: [
 ]
 
 
+## asn, organization_name, domain_name, entity_type, privacy flags
+ASN_SNAPSHOT_KIND = b"ASN1"
+ASN_SNAPSHOT_RECORD = "<IIIIB"
+ASN_PRIVACY_FLAGS = ("tor", "proxy", "vpn", "hosting", "relay", "service")
+
+
+def _snapshot_path():
+    return env.ASN_SNAPSHOT_PATH or os.path.join(env.FILES_DIR, "asn.snapshot")
+
+
+_asn_snapshot = SnapshotHandle(_snapshot_path(), ASN_SNAPSHOT_KIND, ASN_SNAPSHOT_RECORD)
+asn_cache = TTLCache(N_SLOTS, env.ENRICHMENT_CACHE_TTL, env.NEGATIVE_CACHE_TTL)
+
+
+def _snapshot_asn_info(snapshot: Snapshot, ip: str) -> ASN | None:
+    record = snapshot.get(ip)
+    if not record:
+        return None
+    asn, organization_name, domain_name, entity_type, flags = record
+    ## the snapshot was validated when it was built
+    return ASN.from_trusted(
+        {
+            "asn": snapshot.string(asn),
+            "organization_name": snapshot.string(organization_name),
+            "domain_name": snapshot.string(domain_name),
+            "entity_type": snapshot.string(entity_type),
+            **{
+                flag: bool(flags & (1 << bit))
+                for bit, flag in enumerate(ASN_PRIVACY_FLAGS)
+            },
+        }
+    )
+
+
 def get_asn_info(ip: str) -> ASN|None:
-    octects = ip.split(".")
-    octects_copy = [*octects]
-    octects_copy[2] = "0"
-    octects_copy[3] = "0"
-    pipeline = [{"$match": {"ipv4": ".".join(octects_copy)}}, *ASN_PROJECTION()]
-    res = AppDB().ASNRecords.aggregate(pipeline)
-    res = list(map(ASN, res))
-    return None if len(res) == 0 else res[0]
+    if snapshot := _asn_snapshot.get():
+        return _snapshot_asn_info(snapshot, ip)
+    prefix_ = prefix(ip)
+    if prefix_ is None:
+        return None
+    asn_info = asn_cache.get(prefix_)
+    if asn_info is MISSING:
+        pipeline = [{"$match": {"ipv4": prefix_}}, *ASN_PROJECTION()]
+        res = AppDB().ASNRecords.aggregate(pipeline)
+        res = list(map(ASN.from_trusted, res))
+        asn_info = None if len(res) == 0 else res[0]
+        asn_cache.set(prefix_, asn_info)
+    return asn_info
+
+
+## the helpers below are shared with the async client, which only swaps the
+## mongo round trip
+
+
+def asn_infos_pipeline(prefixes: List[str]):
+    projection = ASN_PROJECTION()[0]["$project"]
+    return [
+        {"$match": {"ipv4": {"$in": prefixes}}},
+        {"$project": {**projection, "ipv4": 1}},
+    ]
+
+
+def snapshot_asn_infos(ips: List[str]) -> Dict[str, ASN] | None:
+    ## None when there is no snapshot and mongo has to be asked
+    if not (snapshot := _asn_snapshot.get()):
+        return None
+    asn_infos = {ip: _snapshot_asn_info(snapshot, ip) for ip in ips}
+    return {ip: asn_info for ip, asn_info in asn_infos.items() if asn_info}
+
+
+def cached_asn_infos(ips: List[str]) -> Tuple[Dict[str, str], Dict[str, Any], List[str]]:
+    prefixes = {ip: p for ip in ips if (p := prefix(ip))}
+    asn_infos = {p: asn_cache.get(p) for p in set(prefixes.values())}
+    to_find = [p for p, asn_info in asn_infos.items() if asn_info is MISSING]
+    return prefixes, asn_infos, to_find
+
+
+def resolve_asn_infos(
+    prefixes: Dict[str, str], asn_infos: Dict[str, Any], to_find: List[str], docs: Iterable[Dict]
+) -> Dict[str, ASN]:
+    found = {}
+    for doc in docs:
+        found.setdefault(doc.pop("ipv4"), ASN.from_trusted(doc))
+    for p in to_find:
+        asn_infos[p] = found.get(p)
+        asn_cache.set(p, asn_infos[p])
+    return {ip: asn_infos[p] for ip, p in prefixes.items() if asn_infos[p]}
+
+
+def get_asn_infos(ips: List[str]) -> Dict[str, ASN]:
+    if (asn_infos := snapshot_asn_infos(ips)) is not None:
+        return asn_infos
+    prefixes, asn_infos, to_find = cached_asn_infos(ips)
+    docs = [] if not to_find else AppDB().ASNRecords.aggregate(asn_infos_pipeline(to_find))
+    return resolve_asn_infos(prefixes, asn_infos, to_find, docs)
+
+
+def build_asn_snapshot(path: str = None) -> Dict:
+    path = path or _snapshot_path()
+    writer = SnapshotWriter(ASN_SNAPSHOT_KIND, ASN_SNAPSHOT_RECORD)
+    projection = ASN_PROJECTION()[0]["$project"]
+    pipeline = [{"$project": {**projection, "ipv4": 1}}]
+    n_records, n_skipped = 0, 0
+    for doc in AppDB().ASNRecords.aggregate(pipeline, batchSize=10000):
+        ipv4 = doc.pop("ipv4", None)
+        try:
+            asn_info = ASN(doc)
+        except ValueError:
+            n_skipped += 1
+            continue
+        flags = 0
+        for bit, flag in enumerate(ASN_PRIVACY_FLAGS):
+            if asn_info[flag]:
+                flags |= 1 << bit
+        ## invalid or missing ipv4 have no slot
+        if not writer.put(
+            ipv4,
+            writer.string(asn_info.asn),
+            writer.string(asn_info.organization_name),
+            writer.string(asn_info.domain_name),
+            writer.string(asn_info.entity_type),
+            flags,
+        ):
+            n_skipped += 1
+            continue
+        n_records += 1
+    version = writer.write(path)
+    return {"path": path, "version": version, "records": n_records, "skipped": n_skipped}
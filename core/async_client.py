@@ -0,0 +1,76 @@
+import asyncio
+from typing import Any, Dict, List
+
+from enums import IOCType
+from database import AsyncAppDB
+from models import ASN, GeoLocation
+from . import iocs, geo, asn, client
+from .bloom import blacklist_filter
+
+
+async def ioc_lookups(type_: IOCType, iocs_: List[Any]) -> Dict[Any, Dict]:
+    iocs_ = [ioc for ioc in iocs_ if blacklist_filter.might_contain(type_, ioc)]
+    if not iocs_:
+        return {}
+    cursor = await AsyncAppDB().IOCs.aggregate(iocs.ioc_lookups_pipeline(type_, iocs_))
+    return iocs.ioc_lookups_result(await cursor.to_list(None))
+
+
+async def ioc_lookup(type_: IOCType, ioc: Any) -> Dict | None:
+    if not blacklist_filter.might_contain(type_, ioc):
+        return None
+    cursor = await AsyncAppDB().IOCs.aggregate(iocs.ioc_lookup_pipeline(type_, ioc))
+    res = await cursor.to_list(None)
+    if len(res) == 0:
+        return None
+    return iocs.ioc_lookup_result(res[0])
+
+
+async def get_locations(ips: List[str]) -> Dict[str, GeoLocation]:
+    if (locations := geo.snapshot_locations(ips)) is not None:
+        return locations
+    prefixes, locations, to_find = geo.cached_locations(ips)
+    docs = []
+    if to_find:
+        docs = await AsyncAppDB().GeoLocation.find(geo.locations_query(to_find)).to_list(None)
+    return geo.resolve_locations(prefixes, locations, to_find, docs)
+
+
+async def get_asn_infos(ips: List[str]) -> Dict[str, ASN]:
+    if (asn_infos := asn.snapshot_asn_infos(ips)) is not None:
+        return asn_infos
+    prefixes, asn_infos, to_find = asn.cached_asn_infos(ips)
+    docs = []
+    if to_find:
+        cursor = await AsyncAppDB().ASNRecords.aggregate(asn.asn_infos_pipeline(to_find))
+        docs = await cursor.to_list(None)
+    return asn.resolve_asn_infos(prefixes, asn_infos, to_find, docs)
+
+
+async def get_location(ip: str) -> GeoLocation | None:
+    return (await get_locations([ip])).get(ip)
+
+
+async def get_asn_info(ip: str) -> ASN | None:
+    return (await get_asn_infos([ip])).get(ip)
+
+
+async def enrich_ioc(type_: IOCType, ioc: Any):
+    return (await enrich_iocs(type_=type_, iocs_=[ioc]))[0]
+
+
+async def _enrich_iocs(type_: IOCType, iocs_: List[Any]):
+    ip_ports = client.ip_ports(type_, iocs_)
+    ips = list({ip for ip, _ in ip_ports.values()})
+    ioc_lookups_, locations, asn_infos = await asyncio.gather(
+        ioc_lookups(type_=type_, iocs_=iocs_),
+        get_locations(ips),
+        get_asn_infos(ips),
+    )
+    return client.enrichments(type_, iocs_, ioc_lookups_, ip_ports, locations, asn_infos)
+
+
+async def enrich_iocs(type_: IOCType, iocs_: List[Any]):
+    cached, to_enrich = client.cached_enrichments(type_, iocs_)
+    enriched = [] if not to_enrich else await _enrich_iocs(type_=type_, iocs_=to_enrich)
+    return client.cache_enrichments(type_, cached, enriched)
@@ -0,0 +1,239 @@
+import os
+import math
+import time
+import struct
+import hashlib
+import threading
+from datetime import timedelta
+from typing import Any, Dict, Iterable, List
+
+from bson import ObjectId
+
+from enums import IOCType
+from database import AppDB
+from globals_ import env
+from . import iocs
+
+
+class BloomFilter:
+
+    def __init__(self, capacity: int, error_rate: float = 0.001, bits: bytearray = None, n_hashes: int = None):
+        capacity = max(capacity, 1)
+        n_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.n_bits = n_bits if bits is None else len(bits) * 8
+        self.n_hashes = n_hashes or max(1, round(self.n_bits / capacity * math.log(2)))
+        self.bits = bytearray(math.ceil(self.n_bits / 8)) if bits is None else bits
+
+    def _positions(self, val: Any):
+        digest = hashlib.blake2b(str(val).encode("utf-8"), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        return ((h1 + i * h2) % self.n_bits for i in range(self.n_hashes))
+
+    def add(self, val: Any):
+        for pos in self._positions(val):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, val: Any):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(val))
+
+
+## file layout
+##   magic | last ingested _id | n_filters
+##   per filter: ioc type (16s) | n_hashes | n_bytes | bits
+
+_MAGIC = b"IOCBLM1\0"
+_HEADER = struct.Struct("<8s12sI")
+_FILTER_HEADER = struct.Struct("<16sIQ")
+
+
+class BlacklistFilter:
+
+    def __init__(self, catch_up_interval: float, catch_up_lag: float, save_interval: float):
+        self._catch_up_interval = catch_up_interval
+        self._catch_up_lag = timedelta(seconds=catch_up_lag)
+        self._save_interval = save_interval
+        self._filters: Dict[IOCType, BloomFilter] = {}
+        self._last_id = ObjectId("0" * 24)
+        self._caught_up_at = float("-inf")
+        self._saved_at = float("-inf")
+        self._saved_id = self._last_id
+        self._path = None
+        self._pending: List[Dict[IOCType, List[Any]]] = []
+        self._lock = threading.Lock()
+        self._catching_up = threading.Lock()
+        self.ready = False
+
+    def _add_keys(self, keys: Dict[IOCType, List[Any]]):
+        for type_, vals in keys.items():
+            if type_ in self._filters:
+                for val in vals:
+                    self._filters[type_].add(val)
+
+    def add(self, keys: Dict[IOCType, List[Any]]):
+        with self._lock:
+            if not self.ready:
+                self._pending.append(keys)
+                return
+            self._add_keys(keys)
+
+    def _findings(self, since: ObjectId) -> Iterable[Dict]:
+        return (
+            AppDB()
+            .IOCs.find({"_id": {"$gt": since}}, {"keys": 1})
+            .sort("_id", 1)
+            .batch_size(10000)
+        )
+
+    def _since(self) -> ObjectId:
+        ## ids from concurrent writers are not monotonic, a finding can land
+        ## behind the watermark, so every catch up re-reads a lag window
+        if self._last_id == ObjectId("0" * 24):
+            return self._last_id
+        return ObjectId.from_datetime(self._last_id.generation_time - self._catch_up_lag)
+
+    def _catch_up(self):
+        try:
+            for doc in self._findings(self._since()):
+                with self._lock:
+                    self._add_keys(iocs.finding_keys(doc))
+                    self._last_id = max(self._last_id, doc["_id"])
+        finally:
+            self._caught_up_at = time.monotonic()
+        if (
+            self._path
+            and self._last_id != self._saved_id
+            and time.monotonic() - self._saved_at > self._save_interval
+        ):
+            self.save(self._path)
+
+    def _catch_up_in_background(self):
+        try:
+            self._catch_up()
+        except Exception as e:
+            print(f"blacklist filter catch up failed: {e}")
+        finally:
+            self._catching_up.release()
+
+    def might_contain(self, type_: IOCType, ioc: Any) -> bool:
+        if not self.ready or type_ not in self._filters:
+            return True
+        if time.monotonic() - self._caught_up_at > self._catch_up_interval:
+            ## covers findings missed when change streams are not available,
+            ## one catch up at a time
+            if self._catching_up.acquire(blocking=False):
+                threading.Thread(target=self._catch_up_in_background, daemon=True).start()
+        return ioc in self._filters[type_]
+
+    def build(self, error_rate: float = 0.001):
+        counts = AppDB().IOCs.aggregate(
+            [
+                {"$project": {"k": {"$objectToArray": "$keys"}}},
+                {"$unwind": "$k"},
+                {
+                    "$group": {
+                        "_id": "$k.k",
+                        "n": {"$sum": {"$cond": [{"$isArray": "$k.v"}, {"$size": "$k.v"}, 1]}},
+                    }
+                },
+            ]
+        )
+        counts = {
+            IOCType(doc["_id"]): doc["n"]
+            for doc in counts
+            if doc["_id"] in IOCType._value2member_map_
+        }
+        with self._lock:
+            self.ready = False
+            self._filters = {
+                type_: BloomFilter(capacity=counts.get(type_, 0), error_rate=error_rate)
+                for type_ in IOCType
+            }
+            self._last_id = ObjectId("0" * 24)
+        for doc in self._findings(self._last_id):
+            self._add_keys(iocs.finding_keys(doc))
+            self._last_id = doc["_id"]
+        self._set_ready()
+
+    def _set_ready(self):
+        with self._lock:
+            for keys in self._pending:
+                self._add_keys(keys)
+            self._pending = []
+            self.ready = True
+            self._caught_up_at = time.monotonic()
+
+    def save(self, path: str):
+        ## the watermark written must not be ahead of the bits written with it
+        with self._lock:
+            last_id = self._last_id
+            filters = {
+                type_: (filter_.n_hashes, bytes(filter_.bits))
+                for type_, filter_ in self._filters.items()
+            }
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, last_id.binary, len(filters)))
+            for type_, (n_hashes, bits) in filters.items():
+                f.write(_FILTER_HEADER.pack(type_.value.encode("utf-8"), n_hashes, len(bits)))
+                f.write(bits)
+        os.replace(tmp_path, path)
+        self._saved_id = last_id
+        self._saved_at = time.monotonic()
+
+    def load(self, path: str):
+        with open(path, "rb") as f:
+            magic, last_id, n_filters = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC:
+                e = f"{path} is not a blacklist filter file"
+                raise ValueError(e)
+            filters = {}
+            for _ in range(n_filters):
+                type_, n_hashes, n_bytes = _FILTER_HEADER.unpack(
+                    f.read(_FILTER_HEADER.size)
+                )
+                type_ = IOCType(type_.rstrip(b"\0").decode("utf-8"))
+                filters[type_] = BloomFilter(
+                    capacity=1, bits=bytearray(f.read(n_bytes)), n_hashes=n_hashes
+                )
+        with self._lock:
+            self._filters = filters
+            self._last_id = ObjectId(last_id)
+            self._saved_id = self._last_id
+            self._path = path
+        with self._catching_up:
+            self._catch_up()
+        self._set_ready()
+
+
+def _filter_path():
+    return env.BLACKLIST_FILTER_PATH or os.path.join(env.FILES_DIR, "blacklist.bloom")
+
+
+blacklist_filter = BlacklistFilter(
+    catch_up_interval=env.BLACKLIST_FILTER_CATCH_UP_INTERVAL,
+    catch_up_lag=env.BLACKLIST_FILTER_CATCH_UP_LAG,
+    save_interval=env.BLACKLIST_FILTER_SAVE_INTERVAL,
+)
+iocs.on_ingest(blacklist_filter.add)
+
+
+def load_blacklist_filter():
+    path = _filter_path()
+    if not os.path.exists(path):
+        print(f"no blacklist filter at {path}, ioc lookups will not be prefiltered")
+        return
+    blacklist_filter.load(path)
+
+
+def build_blacklist_filter(path: str = None) -> Dict:
+    path = path or _filter_path()
+    blacklist_filter.build()
+    blacklist_filter.save(path)
+    return {
+        "path": path,
+        "last_id": str(blacklist_filter._last_id),
+        "filters": {
+            type_.value: {"bytes": len(f.bits), "hashes": f.n_hashes}
+            for type_, f in blacklist_filter._filters.items()
+        },
+    }
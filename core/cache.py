@@ -0,0 +1,86 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Set, Tuple
+
+MISSING = object()
+
+
+class TTLCache:
+
+    def __init__(self, maxsize: int, ttl: float, negative_ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._data: OrderedDict[Hashable, Tuple[float, Any, Hashable]] = OrderedDict()
+        self._tags: Dict[Hashable, Set[Hashable]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def _drop(self, key: Hashable):
+        _, _, tag = self._data.pop(key)
+        if tag is not None and tag in self._tags:
+            self._tags[tag].discard(key)
+            if not self._tags[tag]:
+                del self._tags[tag]
+
+    def get(self, key: Hashable, default=MISSING):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            if entry[0] < time.monotonic():
+                self._drop(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, tag: Hashable = None):
+        ttl = self.negative_ttl if value is None else self.ttl
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            self._data[key] = (time.monotonic() + ttl, value, tag)
+            if tag is not None:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._drop(next(iter(self._data)))
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+                self.invalidations += 1
+
+    def invalidate_tag(self, tag: Hashable):
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._drop(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": 0 if lookups == 0 else self.hits / lookups,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
@@ -1,14 +1,37 @@
-from typing import Any
+from typing import Any, Dict, List, Tuple
 
 from enums import IOCType, Lang
-from . import iocs, geo, asn, sources, ipdr
+from models import ASN, GeoLocation, Organization, SourceTypeVar
+from globals_ import env
+from . import iocs, geo, asn, ipdr
+from .cache import MISSING, TTLCache
+from .bloom import blacklist_filter
 
+enrichment_cache = TTLCache(env.ENRICHMENT_CACHE_SIZE, env.ENRICHMENT_CACHE_TTL)
+ipdr_enrichment_cache = TTLCache(env.ENRICHMENT_CACHE_SIZE, env.ENRICHMENT_CACHE_TTL)
+
+
+def split_ip_port(ioc: str):
+    if ":" in ioc:
+        ip, port = ioc.split(":")
+        port = int(port)
+    else:
+        ip, port = ioc, None
+    return ip, port
 
-def enrich_ioc(type_: IOCType, ioc: Any):
+
+def enrichment(
+    type_: IOCType,
+    ioc: Any,
+    ioc_lookup: Dict | None,
+    sources_: List[SourceTypeVar],
+    location: GeoLocation | None = None,
+    asn_info: ASN | None = None,
+    org: Organization | None = None,
+):
 
     meta = {}
 
-    ioc_lookup = iocs.ioc_lookup(type_=type_, ioc=ioc)
     meta["blacklisted"] = False
     meta["blacklisted_sources"] = []
     meta["blacklisted_date"] = None
@@ -19,7 +42,6 @@ def enrich_ioc(type_: IOCType, ioc: Any):
         meta["blacklisted_sources"] = [s["key"] for s in ioc_lookup["sources"]]
         meta["blacklisted_date"] = ioc_lookup["first_occurred_at"]
 
-    sources_ = sources.get_ioc_sources(type_=type_, ioc=ioc)
     if sources_:
         for source in sources_:
             if threat_type := source.attribution.get("threat_type"):
@@ -28,12 +50,6 @@ def enrich_ioc(type_: IOCType, ioc: Any):
                 meta["blacklisted_sources"].append(source.key)
 
     if type_ == IOCType.ipv4:
-        if ":" in ioc:
-            ip, port = ioc.split(":")
-            port = int(port)
-        else:
-            ip, port = ioc, None
-        location = geo.get_location(ip=ip)
         meta["country"] = None
         meta["city"] = None
         meta["continent"] = None
@@ -52,7 +68,6 @@ def enrich_ioc(type_: IOCType, ioc: Any):
             meta["lat"] = location.location.latitude
             meta["long"] = location.location.longitude
 
-        asn_info = asn.get_asn_info(ip=ip)
         meta["asn"] = None
         meta["organization_name"] = None
         meta["domain_name"] = None
@@ -66,8 +81,6 @@ def enrich_ioc(type_: IOCType, ioc: Any):
         if asn_info:
             meta = {**meta, **asn_info}
 
-        
-        org = None if not port else ipdr.get_voip_application(ip=ip, port=port)
         meta["is_voip"] = False
         meta["voip_app"] = None
         if org:
@@ -77,15 +90,140 @@ def enrich_ioc(type_: IOCType, ioc: Any):
     return {"type_": type_, "entity": ioc, **meta}
 
 
+def cache_tag(type_: IOCType, ioc: Any):
+    if type_ == IOCType.ipv4 and isinstance(ioc, str):
+        return type_, split_ip_port(ioc)[0]
+    return type_, ioc
+
+
+@iocs.on_ingest
+def _invalidate_enrichments(keys: Dict[IOCType, List[Any]]):
+    for type_, vals in keys.items():
+        for val in vals:
+            ## entries are tagged by the ip without its port, so an ingested
+            ## ip:port has to invalidate every port of that ip
+            try:
+                tag = cache_tag(type_, val)
+            except ValueError:
+                tag = (type_, val)
+            enrichment_cache.invalidate_tag(tag)
+
+
+def cached_enrichments(type_: IOCType, iocs_: List[Any]) -> Tuple[Dict[Any, Any], List[Any]]:
+    cached = {ioc: enrichment_cache.get((type_, ioc)) for ioc in dict.fromkeys(iocs_)}
+    return cached, [ioc for ioc, res in cached.items() if res is MISSING]
+
+
+def cache_enrichments(type_: IOCType, cached: Dict[Any, Any], enriched: List[Dict]) -> List[Dict]:
+    for res in enriched:
+        ioc = res["entity"]
+        enrichment_cache.set((type_, ioc), res, tag=cache_tag(type_, ioc))
+        cached[ioc] = res
+    return list(cached.values())
+
+
+def ip_ports(type_: IOCType, iocs_: List[Any]) -> Dict[Any, Tuple[str, int | None]]:
+    if type_ != IOCType.ipv4:
+        return {}
+    return {ioc: split_ip_port(ioc) for ioc in iocs_}
+
+
+def enrichments(
+    type_: IOCType,
+    iocs_: List[Any],
+    ioc_lookups: Dict[Any, Dict],
+    ip_ports_: Dict[Any, Tuple[str, int | None]],
+    locations: Dict[str, GeoLocation],
+    asn_infos: Dict[str, ASN],
+) -> List[Dict]:
+    ## served from the in-memory network index, nothing to await
+    with_port = [(ip, port) for ip, port in ip_ports_.values() if port]
+    orgs = {} if not with_port else ipdr.get_voip_applications(with_port)
+    res = []
+    for ioc in iocs_:
+        ioc_lookup = ioc_lookups.get(ioc)
+        sources_ = [] if not ioc_lookup else ioc_lookup["resolved_sources"]
+        location, asn_info, org = None, None, None
+        if ioc in ip_ports_:
+            ip, port = ip_ports_[ioc]
+            location = locations.get(ip)
+            asn_info = asn_infos.get(ip)
+            org = None if not port else orgs.get((ip, port))
+        res.append(
+            enrichment(type_, ioc, ioc_lookup, sources_, location, asn_info, org)
+        )
+    return res
+
+
+def enrich_ioc(type_: IOCType, ioc: Any):
+    cached, to_enrich = cached_enrichments(type_, [ioc])
+    if to_enrich:
+        cache_enrichments(type_, cached, [_enrich_ioc(type_=type_, ioc=ioc)])
+    return cached[ioc]
+
+
+def _enrich_ioc(type_: IOCType, ioc: Any):
+
+    ioc_lookup = None
+    if blacklist_filter.might_contain(type_, ioc):
+        ioc_lookup = iocs.ioc_lookup(type_=type_, ioc=ioc)
+    sources_ = [] if not ioc_lookup else ioc_lookup["resolved_sources"]
+
+    location, asn_info, org = None, None, None
+    if type_ == IOCType.ipv4:
+        ip, port = split_ip_port(ioc)
+        location = geo.get_location(ip=ip)
+        asn_info = asn.get_asn_info(ip=ip)
+        org = None if not port else ipdr.get_voip_application(ip=ip, port=port)
+
+    return enrichment(type_, ioc, ioc_lookup, sources_, location, asn_info, org)
+
+
+def enrich_iocs(type_: IOCType, iocs_: List[Any], use_cache: bool = True):
+    if not use_cache:
+        return _enrich_iocs(type_=type_, iocs_=list(dict.fromkeys(iocs_)))
+    cached, to_enrich = cached_enrichments(type_, iocs_)
+    enriched = [] if not to_enrich else _enrich_iocs(type_=type_, iocs_=to_enrich)
+    return cache_enrichments(type_, cached, enriched)
+
+
+def _enrich_iocs(type_: IOCType, iocs_: List[Any]):
+    ioc_lookups = iocs.ioc_lookups(
+        type_=type_,
+        iocs=[ioc for ioc in iocs_ if blacklist_filter.might_contain(type_, ioc)],
+    )
+    ip_ports_ = ip_ports(type_, iocs_)
+    ips = list({ip for ip, _ in ip_ports_.values()})
+    locations = {} if not ips else geo.get_locations(ips)
+    asn_infos = {} if not ips else asn.get_asn_infos(ips)
+    return enrichments(type_, iocs_, ioc_lookups, ip_ports_, locations, asn_infos)
+
+
 def get_ipdr_enrichment(ip: str, port: int = None):
+    res = ipdr_enrichment_cache.get((ip, port))
+    if res is MISSING:
+        res = _get_ipdr_enrichment(ip=ip, port=port)
+        ipdr_enrichment_cache.set((ip, port), res)
+    return res
+
+
+def _get_ipdr_enrichment(ip: str, port: int = None):
     networks = ipdr.get_networks(ip)
     orgs = ipdr.get_organizations(ip)
     voip_app = None
     if port:
         voip_app = ipdr.get_voip_application(ip, port)
-    
+
     return {
         "networks": [{"host_addr": network.host_addr, "network_addr": network.network_addr} for network in networks],
         "organization": [{"name": org.name} for org in orgs],
         "voip_app": None if not voip_app else voip_app.name
-    }
\ No newline at end of file
+    }
+
+def cache_stats():
+    return {
+        "enrichment": enrichment_cache.stats(),
+        "ipdr_enrichment": ipdr_enrichment_cache.stats(),
+        "location": geo.location_cache.stats(),
+        "asn": asn.asn_cache.stats(),
+    }
@@ -1,13 +1,133 @@
+import os
+from typing import Any, Dict, Iterable, List, Tuple
+
 from database import AppDB
+from enums import Lang
 from models import GeoLocation
+from globals_ import env
+from .snapshot import N_SLOTS, Snapshot, SnapshotHandle, SnapshotWriter, slot
+from .cache import MISSING, TTLCache
+
+## lat, long, country, city, continent, subdivisions (start, count)
+GEO_SNAPSHOT_KIND = b"GEO1"
+GEO_SNAPSHOT_RECORD = "<ddIIIII"
+
+
+def _snapshot_path():
+    return env.GEO_SNAPSHOT_PATH or os.path.join(env.FILES_DIR, "geo.snapshot")
+
+
+_geo_snapshot = SnapshotHandle(_snapshot_path(), GEO_SNAPSHOT_KIND, GEO_SNAPSHOT_RECORD)
+location_cache = TTLCache(N_SLOTS, env.ENRICHMENT_CACHE_TTL, env.NEGATIVE_CACHE_TTL)
+
+
+def prefix(ip: str) -> str | None:
+    if (i := slot(ip)) is None:
+        return None
+    return f"{i >> 8}.{i & 0xFF}.0.0"
+
+
+def _names(snapshot: Snapshot, i: int):
+    name = snapshot.string(i)
+    return {"names": {} if name is None else {Lang.En.value: name}}
+
+
+def _snapshot_location(snapshot: Snapshot, ip: str) -> GeoLocation | None:
+    record = snapshot.get(ip)
+    if not record:
+        return None
+    lat, long, country, city, continent, subdiv_st, subdiv_count = record
+    ## the snapshot was validated when it was built
+    return GeoLocation.from_trusted(
+        {
+            "ipv4": prefix(ip),
+            "location": {"latitude": lat, "longitude": long},
+            "country": _names(snapshot, country),
+            "city": _names(snapshot, city),
+            "continent": _names(snapshot, continent),
+            "subdivisions": [
+                _names(snapshot, i) for i in snapshot.extra(subdiv_st, subdiv_count)
+            ],
+        }
+    )
 
 
 def get_location(ip: str) -> GeoLocation|None:
-    octects = ip.split(".")
-    octects_copy = [*octects]
-    octects_copy[2] = "0"
-    octects_copy[3] = "0"
-    location = AppDB().GeoLocation.find_one({"ipv4": ".".join(octects_copy)})
-    if not location:
-        return None
-    return GeoLocation(location)
+    if snapshot := _geo_snapshot.get():
+        return _snapshot_location(snapshot, ip)
+    prefix_ = prefix(ip)
+    if prefix_ is None:
+        return None
+    location = location_cache.get(prefix_)
+    if location is MISSING:
+        location = AppDB().GeoLocation.find_one({"ipv4": prefix_})
+        location = None if not location else GeoLocation.from_trusted(location)
+        location_cache.set(prefix_, location)
+    return location
+
+
+## the helpers below are shared with the async client, which only swaps the
+## mongo round trip
+
+
+def snapshot_locations(ips: List[str]) -> Dict[str, GeoLocation] | None:
+    ## None when there is no snapshot and mongo has to be asked
+    if not (snapshot := _geo_snapshot.get()):
+        return None
+    locations = {ip: _snapshot_location(snapshot, ip) for ip in ips}
+    return {ip: location for ip, location in locations.items() if location}
+
+
+def cached_locations(ips: List[str]) -> Tuple[Dict[str, str], Dict[str, Any], List[str]]:
+    prefixes = {ip: p for ip in ips if (p := prefix(ip))}
+    locations = {p: location_cache.get(p) for p in set(prefixes.values())}
+    to_find = [p for p, location in locations.items() if location is MISSING]
+    return prefixes, locations, to_find
+
+
+def locations_query(prefixes: List[str]) -> Dict:
+    return {"ipv4": {"$in": prefixes}}
+
+
+def resolve_locations(
+    prefixes: Dict[str, str], locations: Dict[str, Any], to_find: List[str], docs: Iterable[Dict]
+) -> Dict[str, GeoLocation]:
+    found = {doc["ipv4"]: GeoLocation.from_trusted(doc) for doc in docs}
+    for p in to_find:
+        locations[p] = found.get(p)
+        location_cache.set(p, locations[p])
+    return {ip: locations[p] for ip, p in prefixes.items() if locations[p]}
+
+
+def get_locations(ips: List[str]) -> Dict[str, GeoLocation]:
+    if (locations := snapshot_locations(ips)) is not None:
+        return locations
+    prefixes, locations, to_find = cached_locations(ips)
+    docs = [] if not to_find else AppDB().GeoLocation.find(locations_query(to_find))
+    return resolve_locations(prefixes, locations, to_find, docs)
+
+
+def build_geo_snapshot(path: str = None) -> Dict:
+    path = path or _snapshot_path()
+    writer = SnapshotWriter(GEO_SNAPSHOT_KIND, GEO_SNAPSHOT_RECORD)
+    n_records, n_skipped = 0, 0
+    for doc in AppDB().GeoLocation.find({}, {"_id": 0}).batch_size(10000):
+        try:
+            location = GeoLocation(doc)
+        except ValueError:
+            n_skipped += 1
+            continue
+        subdivs = writer.extra(
+            writer.string(s.names.get(Lang.En)) for s in location.subdivisions
+        )
+        n_records += writer.put(
+            location.ipv4,
+            location.location.latitude,
+            location.location.longitude,
+            writer.string(location.country.names.get(Lang.En)),
+            writer.string(location.city.names.get(Lang.En)),
+            writer.string(location.continent.names.get(Lang.En)),
+            *subdivs,
+        )
+    version = writer.write(path)
+    return {"path": path, "version": version, "records": n_records, "skipped": n_skipped}
@@ -1,21 +1,102 @@
+import re
 import math
+import time
 from pytz import UTC
 from datetime import datetime, timedelta
-from typing import Dict, List, Union, Any
+from collections import Counter
+from typing import Callable, Dict, Iterator, List, Union, Any
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure, PyMongoError
 
 from enums import IOCType
-from models import IOCFinding, IOCFindingV2, SortOrder
+from models import IOCFinding, IOCFindingV2, SortOrder, create_source
 from database import AppDB
-from utils import mongo_serializer
+from utils import mongo_serializer, encode_cursor, decode_cursor
+from . import ngrams
 
 
-def get_iocs(
-    page: int,
+def _sort_keys(sort_by: Union[str, None], sort_order: SortOrder, default=None):
+    if sort_by:
+        direction = 1 if sort_order == "asc" else -1
+    else:
+        sort_by, direction = default or ("_id", -1)
+    keys = [] if sort_by == "_id" else [(sort_by, direction)]
+    ## _id breaks ties so that every document has a unique position
+    return keys + [("_id", direction)]
+
+
+def _get_path(doc: Dict, path: str):
+    for key in path.split("."):
+        doc = doc.get(key) if isinstance(doc, dict) else None
+    return doc
+
+
+def _encode_page_cursor(sort_keys, doc: Dict) -> str:
+    return encode_cursor(
+        {
+            "sort": [[k, d] for k, d in sort_keys],
+            "values": [_get_path(doc, k) for k, _ in sort_keys],
+        }
+    )
+
+
+def _seek_stage(sort_keys, cursor: str):
+    cursor = decode_cursor(cursor)
+    if cursor.get("sort") != [[k, d] for k, d in sort_keys]:
+        e = "cursor does not match the requested sort"
+        raise ValueError(e)
+    if len(cursor["values"]) != len(sort_keys):
+        e = "invalid cursor"
+        raise ValueError(e)
+    vals = dict(zip([k for k, _ in sort_keys], cursor["values"]))
+    (key, direction), *_ = sort_keys
+    op = "$gt" if direction == 1 else "$lt"
+    if key == "_id":
+        return {"$match": {"_id": {op: vals["_id"]}}}
+    ties = {key: vals[key], "_id": {op: vals["_id"]}}
+    ## comparisons are type bracketed, {$gt: null} matches nothing, while
+    ## null and missing values sort before everything else
+    if vals[key] is None:
+        if direction == 1:
+            return {"$match": {"$or": [{key: {"$ne": None}}, ties]}}
+        return {"$match": ties}
+    branches = [{key: {op: vals[key]}}, ties]
+    if direction == -1:
+        branches.append({key: None})
+    return {"$match": {"$or": branches}}
+
+
+def _cursor_page(
+    collection,
+    pipeline: List[Dict],
+    sort_keys,
+    cursor: Union[str, None],
     limit: int,
+    projection: Union[Dict, None] = None,
+):
+    if cursor:
+        pipeline = [*pipeline, _seek_stage(sort_keys, cursor)]
+    pipeline = [*pipeline, {"$sort": dict(sort_keys)}, {"$limit": limit + 1}]
+    if projection:
+        pipeline.append(projection)
+    data = list(collection.aggregate(mongo_serializer(pipeline)))
+    has_next_page = len(data) > limit
+    data = data[:limit]
+    return {
+        "data": data,
+        "next_cursor": None if not has_next_page else _encode_page_cursor(sort_keys, data[-1]),
+        "total_results": None,
+        "total_pages": None,
+        "page_no": None,
+        "per_page": limit,
+        "has_next_page": has_next_page,
+        "has_prev_page": cursor is not None,
+    }
+
+
+def _iocs_match(
     type_: Union[IOCType, None] = None,
     filters: Dict[str, List] = {},
-    sort_by: Union[str, None] = None,
-    sort_order: SortOrder = "asc",
     date_from: datetime = None,
     date_to: datetime = None,
 ):
@@ -25,28 +106,76 @@ def get_iocs(
     # pipeline.append({"$unwind": f"$keys.{type_.value}"})
     if filters:
         if "ioc" in filters:
-            pipeline.append(
-                {"$match": {f"keys.{type_.value}": {"$in": filters["ioc"]}}}
-            )
+            ## without a type the value can sit under any of the keys.* fields,
+            ## each branch of the $or is served by its own keys.<type> index
+            types = [type_] if type_ else list(IOCType)
+            conds = [{f"keys.{t.value}": {"$in": filters["ioc"]}} for t in types]
+            pipeline.append({"$match": conds[0] if len(conds) == 1 else {"$or": conds}})
     if date_from and date_to:
         pipeline.append(
             {"$match": {"created_at": {"$gte": date_from, "$lte": date_to}}}
         )
-    elif date_to:
-        pipeline.append({"$match": {"created_at": {"$gte": date_from}}})
     elif date_from:
+        pipeline.append({"$match": {"created_at": {"$gte": date_from}}})
+    elif date_to:
         pipeline.append({"$match": {"created_at": {"$lte": date_to}}})
-    pipeline.append({"$sort": {"_id": -1}})
-    pipeline.append({"$project": {"_id": 0, "source_meta": 0}})
-    if sort_by:
-        sort = [{"$sort": {sort_by: 1 if sort_order == "asc" else -1}}]
-    else:
-        sort = []
+    return pipeline
+
+
+def _iocs_projection(fields: Union[List[str], None], sort_keys) -> Union[Dict, None]:
+    if fields is None:
+        return None
+    for f in fields:
+        if f not in IOCFinding.model_fields:
+            e = f"No such field {f} in ioc findings"
+            raise ValueError(e)
+    projection = {f: 1 for f in fields}
+    ## sort keys stay projected so that the page cursor can be encoded
+    for k, _ in sort_keys:
+        if not any(k == f or k.startswith(f"{f}.") for f in fields):
+            projection[k] = 1
+    return {"$project": projection}
+
+
+def _finding(doc: Dict, fields: Union[List[str], None]):
+    doc.pop("_id")
+    if fields is None:
+        return IOCFinding.from_trusted(doc)
+    return {f: doc[f] for f in fields if f in doc}
+
+
+def get_iocs(
+    page: int,
+    limit: int,
+    type_: Union[IOCType, None] = None,
+    filters: Dict[str, List] = {},
+    sort_by: Union[str, None] = None,
+    sort_order: SortOrder = "asc",
+    date_from: datetime = None,
+    date_to: datetime = None,
+    cursor: Union[str, None] = None,
+    fields: Union[List[str], None] = None,
+):
+    pipeline = _iocs_match(type_, filters, date_from, date_to)
+    sort_keys = _sort_keys(sort_by, sort_order)
+    projection = _iocs_projection(fields, sort_keys)
+    if cursor is not None:
+        pipeline.append({"$project": {"source_meta": 0}})
+        res = _cursor_page(AppDB().IOCs, pipeline, sort_keys, cursor, limit, projection)
+        res["data"] = [_finding(d, fields) for d in res["data"]]
+        return res
+
+    pipeline.append({"$project": {"source_meta": 0}})
     pipeline.append(
         {
             "$facet": {
                 "agg": [{"$count": "count"}],
-                "paginated": [*sort, {"$skip": (page - 1) * limit}, {"$limit": limit}],
+                "paginated": [
+                    {"$sort": dict(sort_keys)},
+                    {"$skip": (page - 1) * limit},
+                    {"$limit": limit},
+                    *([projection] if projection else []),
+                ],
             }
         }
     )
@@ -66,10 +195,14 @@ def get_iocs(
         has_prev_page = page_no > 1
         has_next_page = page_no < total_pages
         data = res[0]["paginated"]
-    data = list(map(IOCFinding, data))
+    next_cursor = None
+    if has_next_page and data:
+        next_cursor = _encode_page_cursor(sort_keys, data[-1])
+    data = [_finding(d, fields) for d in data]
     # res = list(map(lambda finding: IOCFinding(**finding), res))
     return {
         "data": data,
+        "next_cursor": next_cursor,
         "total_results": total_results,
         "total_pages": total_pages,
         "page_no": page_no,
@@ -79,6 +212,26 @@ def get_iocs(
     }
 
 
+def iter_iocs(
+    type_: Union[IOCType, None] = None,
+    filters: Dict[str, List] = {},
+    sort_by: Union[str, None] = None,
+    sort_order: SortOrder = "asc",
+    date_from: datetime = None,
+    date_to: datetime = None,
+    batch_size: int = 1000,
+) -> Iterator[IOCFinding]:
+    pipeline = _iocs_match(type_, filters, date_from, date_to)
+    pipeline.append({"$project": {"source_meta": 0}})
+    pipeline.append({"$sort": dict(_sort_keys(sort_by, sort_order))})
+    res = AppDB().IOCs.aggregate(
+        mongo_serializer(pipeline), batchSize=batch_size, allowDiskUse=True
+    )
+    with res:
+        for d in res:
+            yield IOCFinding.from_trusted(d)
+
+
 def get_iocs_v2(
     page: int,
     limit: int,
@@ -88,6 +241,7 @@ def get_iocs_v2(
     sort_order: SortOrder = "asc",
     date_from: datetime = None,
     date_to: datetime = None,
+    cursor: Union[str, None] = None,
 ):
     null, true, false = None, True, False
     # return {
@@ -251,25 +405,94 @@ def get_iocs_v2(
     #     "has_prev_page": false,
     # }
 
-    pipeline = [
+    pipeline = _iocs_v2_match(search_key, filters, date_from, date_to)
+    sort_keys = _sort_keys(sort_by, sort_order, default=("first_found_at", -1))
+    if cursor is not None:
+        res = _cursor_page(AppDB().IOCsV3Cahe, pipeline, sort_keys, cursor, limit)
+        for d in res["data"]:
+            d["ioc"] = d["_id"]
+        total_results, total_estimated = count_iocs_v2(
+            search_key, filters, date_from, date_to
+        )
+        res["total_results"] = total_results
+        res["total_pages"] = math.ceil(total_results / limit)
+        res["total_estimated"] = total_estimated
+        return res
+
+    pipeline.append(
         {
-            "$group": {
-                "_id": "$ioc",
-                "type_": {"$first": "$type_"},
-                "sources_ref": {"$addToSet": "$source_ref"},
-                "first_found_at": {"$min": "$created_at"},
-                "last_found_at": {"$max": "$created_at"},
-                "no_occurrences": {"$sum": 1},
+            "$facet": {
+                # "agg": [{"$count": "count"}],
+                "paginated": [
+                    {"$sort": dict(sort_keys)},
+                    {"$skip": (page - 1) * limit},
+                    ## one extra row tells whether a next page exists
+                    {"$limit": limit + 1},
+                ],
             }
-        },
-        {"$set": {"no_sources": {"$size": "$sources_ref"}}},
-    ]
+        }
+    )
+    res = AppDB().IOCsV3Cahe.aggregate(mongo_serializer(pipeline))
+    res = list(res)
+    total_results, total_estimated = 0, False
+    if len(res) == 0 or len(res[0]["paginated"]) == 0:
+        total_pages = 0
+        page_no = 0
+        has_prev_page = False
+        has_next_page = False
+        data = []
+    else:
+        total_results, total_estimated = count_iocs_v2(
+            search_key, filters, date_from, date_to
+        )
+        page_no = page
+        data = res[0]["paginated"]
+        has_next_page = len(data) > limit
+        data = data[:limit]
+        ## an estimate can undershoot what is already on screen
+        total_results = max(
+            total_results, (page_no - 1) * limit + len(data) + has_next_page
+        )
+        total_pages = math.ceil(total_results / limit)
+        has_prev_page = page_no > 1
+    # data = list(map(IOCFindingV2, data))
+    data = list(data)
+    for d in data:
+        d["ioc"] = d["_id"]
+    # res = list(map(lambda finding: IOCFinding(**finding), res))
+
+    return {
+        "data": data,
+        "next_cursor": (
+            None if not has_next_page else _encode_page_cursor(sort_keys, data[-1])
+        ),
+        "total_results": total_results,
+        "total_estimated": total_estimated,
+        "total_pages": total_pages,
+        "page_no": page_no,
+        "per_page": limit,
+        "has_next_page": has_next_page,
+        "has_prev_page": has_prev_page,
+    }
+
+
+def _iocs_v2_match(
+    search_key: Union[str, None] = None,
+    filters: Dict[str, List] = {},
+    date_from: datetime = None,
+    date_to: datetime = None,
+):
     pipeline = []
     # if type_:
     #     pipeline.insert(0, {"$match": {"ioc_types": type_}})
     # pipeline.append({"$unwind": f"$keys.{type_.value}"})
     if search_key:
-        pipeline.append({"$match": {"_id": {"$regex": search_key}}})
+        ## search_key is a literal fragment, the regex only verifies candidates
+        match = {"$regex": re.escape(search_key)}
+        candidates = ngrams.search_candidates(search_key)
+        if candidates is not None:
+            match["$in"] = candidates
+        pipeline.append({"$match": {"_id": match}})
     if filters:
         for k, v in filters.items():
             if k == "source":
@@ -295,58 +518,173 @@ def get_iocs_v2(
     elif date_to:
         date_to = date_to + timedelta(days=2) - timedelta(minutes=1)
         pipeline.append({"$match": {"first_found_at": {"$lte": date_to}}})
-    # pipeline.append({"$sort": {"first_found_at": -1}})
-    # pipeline.append({"$project": {"_id": 0, "source_meta": 0}})
-    if sort_by:
-        sort = [{"$sort": {sort_by: 1 if sort_order == "asc" else -1}}]
-    else:
-        sort = [{"$sort": {"first_found_at": -1}}]
-    pipeline.append(
-        {
-            "$facet": {
-                # "agg": [{"$count": "count"}],
-                "paginated": [*sort, {"$skip": (page - 1) * limit}, {"$limit": limit}],
-            }
-        }
+    return pipeline
+
+
+COUNTED_DIMS = ("type_", "source", "threat_type")
+
+
+def _day(dt: datetime) -> datetime:
+    dt = dt if dt.tzinfo else UTC.localize(dt)
+    return dt.astimezone(UTC).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _count_keys(doc: Dict):
+    day = _day(doc["first_found_at"])
+    keys = {("all", None, day), ("type_", doc.get("type_"), day)}
+    for ref in doc.get("sources_ref", []):
+        keys.add(("source", ref.get("key"), day))
+        if threat_type := (ref.get("attr") or {}).get("threat_type"):
+            keys.add(("threat_type", threat_type, day))
+    return keys
+
+
+def update_ioc_counts(before: List[Dict], after: List[Dict]):
+    delta = Counter()
+    for doc in after:
+        delta.update(_count_keys(doc))
+    for doc in before:
+        delta.subtract(_count_keys(doc))
+    ops = [
+        UpdateOne(
+            {"dim": dim, "value": value, "day": day},
+            {"$inc": {"count": n}},
+            upsert=True,
+        )
+        for (dim, value, day), n in delta.items()
+        if n != 0
+    ]
+    if ops:
+        AppDB().IOCsV3Counts.bulk_write(ops, ordered=False)
+
+
+def rebuild_ioc_counts():
+    counts = AppDB().IOCsV3Counts
+    tmp = counts.database[f"{counts.name}_tmp"]
+    tmp.drop()
+    day = {"$dateTrunc": {"date": "$first_found_at", "unit": "day"}}
+    dims = {
+        "all": [],
+        "type_": [{"$set": {"value": "$type_"}}],
+        "source": [
+            {"$set": {"value": {"$setUnion": ["$sources_ref.key"]}}},
+            {"$unwind": "$value"},
+        ],
+        "threat_type": [
+            {"$set": {"value": {"$setUnion": ["$sources_ref.attr.threat_type"]}}},
+            {"$unwind": "$value"},
+            {"$match": {"value": {"$ne": None}}},
+        ],
+    }
+    for dim, stages in dims.items():
+        AppDB().IOCsV3Cahe.aggregate(
+            [
+                *stages,
+                {"$group": {"_id": {"value": "$value", "day": day}, "count": {"$sum": 1}}},
+                {
+                    "$project": {
+                        "_id": 0,
+                        "dim": {"$literal": dim},
+                        "value": "$_id.value" if dim != "all" else {"$literal": None},
+                        "day": "$_id.day",
+                        "count": 1,
+                    }
+                },
+                {"$merge": {"into": tmp.name}},
+            ],
+            allowDiskUse=True,
+        )
+    tmp.create_index([("dim", 1), ("value", 1), ("day", 1)], unique=True)
+    tmp.rename(counts.name, dropTarget=True)
+    return {dim: counts.count_documents({"dim": dim}) for dim in dims}
+
+
+def _count_iocs_v2_pipeline(pipeline: List[Dict]):
+    res = AppDB().IOCsV3Cahe.aggregate(
+        mongo_serializer([*pipeline, {"$count": "count"}])
     )
-    from pprint import pprint
-    pprint(pipeline)
-    res = AppDB().IOCsV3Cahe.aggregate(mongo_serializer(pipeline))
     res = list(res)
-    if len(res) == 0 or len(res[0]["paginated"]) == 0:
-        total_results = 0
-        total_pages = 0
-        page_no = 0
-        has_prev_page = False
-        has_next_page = False
-        data = []
-    else:
-        # total_results = res[0]["agg"][0]["count"]
-        total_results = 0
-        total_pages = math.ceil(total_results / limit)
-        page_no = page
-        has_prev_page = page_no > 1
-        has_next_page = page_no < total_pages
-        data = res[0]["paginated"]
-    # data = list(map(IOCFindingV2, data))
-    data = list(data)
-    for d in data:
-        d["ioc"] = d["_id"]
-    # res = list(map(lambda finding: IOCFinding(**finding), res))
+    return 0 if not res else res[0]["count"]
+
+
+def _estimate_iocs_v2_count(pipeline: List[Dict], sample_size: int = 1000):
+    total = AppDB().IOCsV3Cahe.estimated_document_count()
+    if total <= sample_size:
+        return _count_iocs_v2_pipeline(pipeline), False
+    res = AppDB().IOCsV3Cahe.aggregate(
+        mongo_serializer(
+            [{"$sample": {"size": sample_size}}, *pipeline, {"$count": "count"}]
+        )
+    )
+    res = list(res)
+    matched = 0 if not res else res[0]["count"]
+    return round(total * matched / sample_size), True
+
 
+def count_iocs_v2(
+    search_key: Union[str, None] = None,
+    filters: Dict[str, List] = {},
+    date_from: datetime = None,
+    date_to: datetime = None,
+):
+    filters = {k: v for k, v in (filters or {}).items() if v}
+    if search_key or len(filters) > 1 or any(k not in COUNTED_DIMS for k in filters):
+        pipeline = _iocs_v2_match(search_key, filters, date_from, date_to)
+        if search_key and ngrams.search_candidates(search_key) is not None:
+            ## bounded by the candidate list, cheap to count exactly
+            return _count_iocs_v2_pipeline(pipeline), False
+        return _estimate_iocs_v2_count(pipeline)
+
+    query = {"dim": "all", "value": None}
+    estimated = False
+    for k, vals in filters.items():
+        query = {"dim": k, "value": {"$in": vals}}
+        ## an ioc can have several sources/threat types, summing them double counts
+        estimated = k != "type_" and len(set(vals)) > 1
+    ## same bounds as _iocs_v2_match, resolved to whole days
+    day_range = {}
+    for op, dt in (("$gte", date_from), ("$lte", date_to)):
+        if dt:
+            day_range[op] = _day(dt) + timedelta(days=1)
+            estimated = estimated or dt.time() != datetime.min.time()
+    if day_range:
+        query["day"] = day_range
+    res = AppDB().IOCsV3Counts.aggregate(
+        [{"$match": query}, {"$group": {"_id": None, "count": {"$sum": "$count"}}}]
+    )
+    res = list(res)
+    return (0 if not res else res[0]["count"]), estimated
+
+
+def _sources_lookup():
     return {
-        "data": data,
-        "total_results": total_results,
-        "total_pages": total_pages,
-        "page_no": page_no,
-        "per_page": limit,
-        "has_next_page": has_next_page,
-        "has_prev_page": has_prev_page,
+        "$lookup": {
+            "from": AppDB().IOCSources.name,
+            "localField": "sources.key",
+            "foreignField": "key",
+            "as": "source_docs",
+        }
     }
 
 
-def ioc_lookup(type_: IOCType, ioc: Any) -> Dict | None:
-    pipeline = [
+def ioc_lookup_result(res: Dict) -> Dict:
+    res["first_occurred_at"] = res.get("first_occurred_at", None)
+    if not isinstance(res["first_occurred_at"], datetime):
+        res["first_occurred_at"] = None
+    if not res["sources"]:
+        res["sources"] = []
+    refs = {(ref["type"], ref["key"]) for ref in res["sources"] if ref}
+    resolved = {}
+    for doc in res.pop("source_docs", []):
+        ref = (doc["type"], doc["key"])
+        if ref in refs and ref not in resolved:
+            resolved[ref] = create_source(doc)
+    res["resolved_sources"] = list(resolved.values())
+    return res
+
+
+def ioc_lookup_pipeline(type_: IOCType, ioc: Any):
+    return [
         {"$match": {f"keys.{type_.value}": ioc}},
         {
             "$group": {
@@ -357,17 +695,104 @@ def ioc_lookup(type_: IOCType, ioc: Any) -> Dict | None:
                 "first_occurred_at": {"$min": "$meta.date"},
             }
         },
+        _sources_lookup(),
     ]
-    res = AppDB().IOCs.aggregate(pipeline)
+
+
+def ioc_lookups_pipeline(type_: IOCType, iocs: List[Any]):
+    key = f"keys.{type_.value}"
+    return [
+        {"$match": {key: {"$in": iocs}}},
+        {"$unwind": f"${key}"},
+        {"$match": {key: {"$in": iocs}}},
+        {
+            "$group": {
+                "_id": f"${key}",
+                "no_occurrences": {"$addToSet": "$_id"},
+                "sources": {"$addToSet": "$source_ref"},
+                "meta": {"$addToSet": "$meta.ransomware_group"},
+                "first_occurred_at": {"$min": "$meta.date"},
+            }
+        },
+        {"$set": {"no_occurrences": {"$size": "$no_occurrences"}}},
+        _sources_lookup(),
+    ]
+
+
+def ioc_lookups_result(res: List[Dict]) -> Dict[Any, Dict]:
+    return {doc.pop("_id"): ioc_lookup_result({"_id": None, **doc}) for doc in res}
+
+
+def ioc_lookup(type_: IOCType, ioc: Any) -> Dict | None:
+    res = AppDB().IOCs.aggregate(ioc_lookup_pipeline(type_, ioc))
     res = list(res)
     if len(res) == 0:
         return None
-    res[0]["first_occurred_at"] = res[0].get("first_occurred_at", None)
-    if not isinstance(res[0]["first_occurred_at"], datetime):
-        res[0]["first_occurred_at"] = None
-    if not res[0]["sources"]:
-        res[0]["sources"] = []
-    return res[0]
+    return ioc_lookup_result(res[0])
+
+
+def ioc_lookups(type_: IOCType, iocs: List[Any]) -> Dict[Any, Dict]:
+    if not iocs:
+        return {}
+    res = AppDB().IOCs.aggregate(ioc_lookups_pipeline(type_, iocs))
+    return ioc_lookups_result(res)
+
+
+_ingest_listeners: List[Callable[[Dict[IOCType, List[Any]]], None]] = []
+
+
+def on_ingest(listener: Callable[[Dict[IOCType, List[Any]]], None]):
+    _ingest_listeners.append(listener)
+    return listener
+
+
+def finding_keys(finding: Dict) -> Dict[IOCType, List[Any]]:
+    keys = {}
+    for type_, vals in finding.get("keys", {}).items():
+        if type_ not in IOCType._value2member_map_:
+            continue
+        keys[IOCType(type_)] = vals if isinstance(vals, list) else [vals]
+    return keys
+
+
+def finding_ingested(finding: Dict):
+    keys = finding_keys(finding)
+    for listener in _ingest_listeners:
+        listener(keys)
+
+
+## change streams need a replica set
+CHANGE_STREAMS_UNSUPPORTED = 40573
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+def watch_ingestion(max_backoff: float = 60):
+    pipeline = [{"$match": {"operationType": {"$in": ["insert", "replace"]}}}]
+    resume_token, backoff = None, 1
+    while True:
+        try:
+            with AppDB().IOCs.watch(pipeline, resume_after=resume_token) as stream:
+                backoff = 1
+                for change in stream:
+                    try:
+                        finding_ingested(change["fullDocument"])
+                    except Exception as e:
+                        print(f"ingest listeners failed on {change['_id']}: {e}")
+                    resume_token = stream.resume_token
+        except OperationFailure as e:
+            if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                print("change streams are not available, not watching ioc ingestion")
+                return
+            if e.code == CHANGE_STREAM_HISTORY_LOST:
+                ## the oplog rolled past the token, caches fall back to their ttl
+                print("ioc ingestion resume token expired, watching from now")
+                resume_token = None
+            else:
+                print(f"ioc ingestion watch failed, retrying in {backoff}s: {e}")
+        except PyMongoError as e:
+            print(f"ioc ingestion watch interrupted, retrying in {backoff}s: {e}")
+        time.sleep(backoff)
+        backoff = min(backoff * 2, max_backoff)
 
 
 def get_type_keys():
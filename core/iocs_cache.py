@@ -0,0 +1,126 @@
+from datetime import timedelta
+from typing import Dict, List
+
+from bson import ObjectId
+
+from database import AppDB
+from utils import curr_time
+from . import iocs, ngrams
+from .watermarks import get_mongo_watermark, set_mongo_watermark
+
+JOB = "iocs_v3_cache"
+
+GROUP_STAGES = [
+    {
+        "$group": {
+            "_id": "$ioc",
+            "type_": {"$first": "$type_"},
+            "sources_ref": {"$addToSet": "$source_ref"},
+            "first_found_at": {"$min": "$created_at"},
+            "last_found_at": {"$max": "$created_at"},
+            "no_occurrences": {"$sum": 1},
+        }
+    },
+    {"$set": {"no_sources": {"$size": "$sources_ref"}}},
+]
+
+## folds a freshly grouped window into the document already in the cache
+MERGE_STAGES = [
+    {
+        "$set": {
+            "sources_ref": {"$setUnion": ["$sources_ref", "$$new.sources_ref"]},
+            "first_found_at": {"$min": ["$first_found_at", "$$new.first_found_at"]},
+            "last_found_at": {"$max": ["$last_found_at", "$$new.last_found_at"]},
+            "no_occurrences": {"$add": ["$no_occurrences", "$$new.no_occurrences"]},
+        }
+    },
+    {"$set": {"no_sources": {"$size": "$sources_ref"}}},
+]
+
+
+def _window_upper(watermark: ObjectId | None, batch_size: int, lag: timedelta):
+    ## findings inserted concurrently may still land behind the newest _id
+    settled = ObjectId.from_datetime(curr_time() - lag)
+    query = {"_id": {"$lt": settled}}
+    if watermark:
+        query["_id"]["$gt"] = watermark
+    last = list(
+        AppDB()
+        .IOCsV3.find(query, {"_id": 1})
+        .sort("_id", 1)
+        .skip(batch_size - 1)
+        .limit(1)
+    )
+    if last:
+        return last[0]["_id"]
+    last = AppDB().IOCsV3.find_one(query, {"_id": 1}, sort=[("_id", -1)])
+    return None if not last else last["_id"]
+
+
+def _cached(iocs_: List) -> List[Dict]:
+    return list(AppDB().IOCsV3Cahe.find({"_id": {"$in": iocs_}}))
+
+
+def _update_window(watermark: ObjectId | None, upper: ObjectId) -> int:
+    window = {"$lte": upper} if not watermark else {"$gt": watermark, "$lte": upper}
+    affected = AppDB().IOCsV3.distinct("ioc", {"_id": window})
+    before = _cached(affected)
+    AppDB().IOCsV3.aggregate(
+        [
+            {"$match": {"_id": window}},
+            *GROUP_STAGES,
+            {
+                "$merge": {
+                    "into": AppDB().IOCsV3Cahe.name,
+                    "on": "_id",
+                    "let": {"new": "$$ROOT"},
+                    "whenMatched": MERGE_STAGES,
+                    "whenNotMatched": "insert",
+                }
+            },
+        ],
+        allowDiskUse=True,
+    )
+    iocs.update_ioc_counts(before, _cached(affected))
+    ## postings already present are skipped, so a replayed window still adds
+    ## the iocs a crash left without postings
+    ngrams.add_iocs(affected)
+    return len(affected)
+
+
+def update_iocs_cache(batch_size: int = 50000, lag_seconds: int = 60) -> Dict:
+    watermark = get_mongo_watermark(JOB)
+    n_windows, n_iocs = 0, 0
+    while upper := _window_upper(watermark, batch_size, timedelta(seconds=lag_seconds)):
+        n_iocs += _update_window(watermark, upper)
+        ## merging is not idempotent, keep the window a crash can replay small
+        set_mongo_watermark(JOB, upper)
+        watermark = upper
+        n_windows += 1
+    return {
+        "watermark": None if not watermark else str(watermark),
+        "windows": n_windows,
+        "iocs": n_iocs,
+    }
+
+
+def rebuild_iocs_cache() -> Dict:
+    last = AppDB().IOCsV3.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    if not last:
+        return {"watermark": None, "iocs": 0}
+    ngrams.invalidate()
+    AppDB().IOCsV3.aggregate(
+        [
+            {"$match": {"_id": {"$lte": last["_id"]}}},
+            *GROUP_STAGES,
+            {"$out": AppDB().IOCsV3Cahe.name},
+        ],
+        allowDiskUse=True,
+    )
+    set_mongo_watermark(JOB, last["_id"])
+    iocs.rebuild_ioc_counts()
+    ngrams.rebuild_ioc_ngrams()
+    return {
+        "watermark": str(last["_id"]),
+        "iocs": AppDB().IOCsV3Cahe.estimated_document_count(),
+    }
@@ -0,0 +1,111 @@
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from sqlalchemy import select, union, func
+from sqlalchemy.dialects.postgresql import insert
+
+from enums import IOCType
+from globals_ import sql_engine, sql_SessionLocal
+from models.sqlalch import NetFlow, IpEnrichment
+from . import client
+from .watermarks import get_sql_watermark, set_sql_watermark
+
+JOB = "ip_enrichment"
+
+
+def _is_ipv4(ip: str):
+    try:
+        return ipaddress.ip_address(ip).version == 4
+    except ValueError:
+        return False
+
+
+def _row(enrichment: Dict) -> Dict:
+    return {
+        "ip": enrichment["entity"],
+        "asn": enrichment["asn"],
+        "organization_name": enrichment["organization_name"],
+        "domain_name": enrichment["domain_name"],
+        "entity_type": enrichment["entity_type"],
+        "tor": enrichment["tor"],
+        "proxy": enrichment["proxy"],
+        "vpn": enrichment["vpn"],
+        "hosting": enrichment["hosting"],
+        "relay": enrichment["relay"],
+        "service": enrichment["service"],
+        "country": enrichment["country"],
+        "city": enrichment["city"],
+        "region": enrichment["region"],
+        "continent": enrichment["continent"],
+        "geo_latitude": enrichment["lat"],
+        "geo_longitude": enrichment["long"],
+        "blacklist": enrichment["blacklisted"],
+        "blacklist_sources": enrichment["blacklisted_sources"],
+        "blacklist_datepublished": enrichment["blacklisted_date"],
+        "threat_types": enrichment["threat_types"],
+    }
+
+
+def _enrich(ips: List[str]) -> List[Dict]:
+    ips = [ip for ip in ips if _is_ipv4(ip)]
+    return [_row(e) for e in client.enrich_iocs(IOCType.ipv4, ips, use_cache=False)]
+
+
+def _upsert(session, rows: List[Dict], chunk_size: int = 1000):
+    ## keeps every statement below the bind parameter limit
+    for i in range(0, len(rows), chunk_size):
+        stmt = insert(IpEnrichment).values(rows[i : i + chunk_size])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[IpEnrichment.ip],
+            set_={c: stmt.excluded[c] for c in rows[0] if c != "ip"},
+        )
+        session.execute(stmt)
+    session.commit()
+
+
+def _unenriched_ips(watermark: str | None, upper: str):
+    conds = [NetFlow.flow_start_timestamp <= upper]
+    if watermark:
+        conds.append(NetFlow.flow_start_timestamp > watermark)
+    ips = union(
+        select(NetFlow.ipv4_src_addr.label("ip")).where(*conds),
+        select(NetFlow.ipv4_dst_addr.label("ip")).where(*conds),
+    ).subquery()
+    return (
+        select(ips.c.ip)
+        .outerjoin(IpEnrichment, IpEnrichment.ip == ips.c.ip)
+        .where(ips.c.ip.isnot(None), ips.c.ip != "", IpEnrichment.ip.is_(None))
+    )
+
+
+def enrich_netflow_ips(batch_size: int = 5000, workers: int = 4) -> Dict:
+    session = sql_SessionLocal()
+    IpEnrichment.__table__.create(sql_engine, checkfirst=True)
+    watermark = get_sql_watermark(session, JOB)
+    upper = session.query(func.max(NetFlow.flow_start_timestamp)).scalar()
+    if upper is None or (watermark and upper <= watermark):
+        session.close()
+        return {"watermark": watermark, "enriched": 0}
+
+    n_enriched = 0
+    with sql_engine.connect() as conn, ThreadPoolExecutor(workers) as pool:
+        res = conn.execution_options(stream_results=True, yield_per=batch_size).execute(
+            _unenriched_ips(watermark, upper)
+        )
+        in_flight = []
+        for partition in res.scalars().partitions():
+            in_flight.append(pool.submit(_enrich, list(partition)))
+            ## bound the batches held in memory
+            if len(in_flight) >= workers * 2:
+                rows = in_flight.pop(0).result()
+                _upsert(session, rows)
+                n_enriched += len(rows)
+        for future in in_flight:
+            rows = future.result()
+            _upsert(session, rows)
+            n_enriched += len(rows)
+
+    set_sql_watermark(session, JOB, upper)
+    session.close()
+    return {"watermark": upper, "enriched": n_enriched}
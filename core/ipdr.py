@@ -1,9 +1,14 @@
+import time
+import bisect
 import ipaddress
-from typing import List
+import threading
+from typing import Dict, List, Tuple
+from pymongo import UpdateOne
 
 from database import AppDB
 from models import Network, Organization
 from utils import mongo_serializer, ID
+from globals_ import env
 
 
 
@@ -16,36 +21,192 @@ def _ip_ord(ip: str):
     return int(ipaddress.ip_address(ip))
 
 
-def get_networks(ip: str) -> List[Network]:
-    ip_val = str(_ip_ord(ip))
-    networks = AppDB().Networks.find(
-        {
-            "$expr": {
-                "$and": [
-                    {"$lte": ["$network_st", ip_val]},
-                    {"$gte": ["$network_en", ip_val]},
-                ]
-            }
+def _range_value(val: int, version: int) -> int | bytes:
+    ## fixed width so BSON compares IPv6 bounds in address order
+    return val if version == 4 else val.to_bytes(16, "big")
+
+
+def _range_int(val: int | bytes) -> int:
+    return val if isinstance(val, int) else int.from_bytes(val, "big")
+
+
+def _range_fields(ip: str) -> Dict:
+    network = ipaddress.ip_network(ip)
+    return {
+        "ip_version": network.version,
+        "range_st": _range_value(int(network.network_address), network.version),
+        "range_en": _range_value(int(network.broadcast_address), network.version),
+        "prefixlen": network.prefixlen,
+    }
+
+
+def _bounds(network: Network) -> Tuple[int, int]:
+    if network.range_st is None:
+        return int(network.network_st), int(network.network_en)
+    return _range_int(network.range_st), _range_int(network.range_en)
+
+
+class NetworkIndex:
+
+    def __init__(self, networks: List[Network], orgs: List[Organization]):
+        self.loaded_at = time.monotonic()
+        self._orgs = {org.id: org for org in orgs}
+        self._segments = {
+            4: self._build_segments([n for n in networks if n.host_addr.version == 4]),
+            6: self._build_segments([n for n in networks if n.host_addr.version == 6]),
         }
-    )
-    networks = list(map(Network, networks))
-    return networks
+
+    @classmethod
+    def _build_segments(cls, networks: List[Network]):
+        ## split the address space at every range boundary, each elementary
+        ## segment keeps the networks covering it (narrowest first)
+        events: Dict[int, List[Tuple[bool, int]]] = {}
+        for i, network in enumerate(networks):
+            st, en = _bounds(network)
+            events.setdefault(st, []).append((True, i))
+            events.setdefault(en + 1, []).append((False, i))
+
+        starts, ends, covering = [], [], []
+        active: Dict[int, Network] = {}
+        positions = sorted(events)
+        for pos, next_pos in zip(positions, positions[1:] + [None]):
+            for is_start, i in events[pos]:
+                if is_start:
+                    active[i] = networks[i]
+                else:
+                    active.pop(i, None)
+            if not active or next_pos is None:
+                continue
+            starts.append(pos)
+            ends.append(next_pos - 1)
+            covering.append(
+                tuple(
+                    sorted(
+                        active.values(),
+                        key=lambda n: _bounds(n)[1] - _bounds(n)[0],
+                    )
+                )
+            )
+        return starts, ends, covering
+
+    def networks(self, ip: str) -> Tuple[Network, ...]:
+        ip_ = ipaddress.ip_address(ip)
+        starts, ends, covering = self._segments[ip_.version]
+        ip_val = int(ip_)
+        i = bisect.bisect_right(starts, ip_val) - 1
+        if i < 0 or ip_val > ends[i]:
+            return ()
+        return covering[i]
+
+    def organizations(self, ip: str) -> List[Organization]:
+        org_ids = {n.belongs_to.id for n in self.networks(ip) if n.belongs_to}
+        orgs = [self._orgs[id_] for id_ in org_ids if id_ in self._orgs]
+        return sorted(orgs, key=lambda org: org.name)
+
+    def voip_application(self, ip: str, port: int) -> Organization | None:
+        for org in self.organizations(ip):
+            if port in org.voip_ports:
+                return org
+        return None
+
+
+_network_index: NetworkIndex | None = None
+_network_index_lock = threading.Lock()
+_network_index_stale = False
+
+
+def load_network_index() -> NetworkIndex:
+    global _network_index, _network_index_stale
+    _network_index_stale = False
+    networks = list(map(Network.from_trusted, AppDB().Networks.find({})))
+    orgs = list(map(Organization.from_trusted, AppDB().Organizations.find({})))
+    _network_index = NetworkIndex(networks, orgs)
+    return _network_index
+
+
+def _refresh_network_index():
+    try:
+        load_network_index()
+    finally:
+        _network_index_lock.release()
+
+
+def invalidate_network_index():
+    global _network_index_stale
+    _network_index_stale = True
+
+
+def get_network_index(block: bool = True) -> NetworkIndex | None:
+    index = _network_index
+    if index is None and not block:
+        if _network_index_lock.acquire(blocking=False):
+            threading.Thread(target=_refresh_network_index, daemon=True).start()
+        return None
+    if index is None:
+        with _network_index_lock:
+            if _network_index is None:
+                return load_network_index()
+            return _network_index
+    expired = time.monotonic() - index.loaded_at > env.IPDR_INDEX_TTL
+    if (expired or _network_index_stale) and _network_index_lock.acquire(blocking=False):
+        ## keep serving the current index while the new one is built
+        threading.Thread(target=_refresh_network_index, daemon=True).start()
+    return index
+
+
+def find_networks(ip: str) -> List[Network]:
+    ip_ = ipaddress.ip_address(ip)
+    ip_val = int(ip_)
+    ## networks are CIDR blocks, so a covering network starts at the ip
+    ## masked to its prefix length, one index seek per prefix length
+    starts = [
+        _range_value(ip_val >> (ip_.max_prefixlen - p) << (ip_.max_prefixlen - p), ip_.version)
+        for p in range(ip_.max_prefixlen + 1)
+    ]
+    query = {
+        "ip_version": ip_.version,
+        "range_st": {"$in": starts},
+        "range_en": {"$gte": _range_value(ip_val, ip_.version)},
+    }
+    networks = map(Network.from_trusted, AppDB().Networks.find(query))
+    return sorted(networks, key=lambda n: _bounds(n)[1] - _bounds(n)[0])
+
+
+def get_networks(ip: str) -> List[Network]:
+    index = get_network_index(block=False)
+    if index is None:
+        ## answer from mongo while the index loads in the background
+        return find_networks(ip)
+    return list(index.networks(ip))
 
 def get_organizations(ip: str) -> List[Organization]:
-    networks = get_networks(ip)
-    org_ids = [network.belongs_to.id for network in networks if network.belongs_to]
-    orgs = AppDB().Organizations.find({"id": {"$in": org_ids}}).sort("name", 1)
-    orgs = list(map(Organization, orgs))
-    return orgs
+    return get_network_index().organizations(ip)
 
 def get_voip_application(ip: str, port: int) -> Organization|None:
-    port = int(port)
-    orgs = get_organizations(ip)
-    for org in orgs:
-        if port in org.voip_ports:
-            return org
-    return None
-    
+    return get_network_index().voip_application(ip, int(port))
+
+
+def get_voip_applications(ip_ports: List[Tuple[str, int]]) -> Dict[Tuple[str, int], Organization]:
+    index = get_network_index()
+    voip_apps = {}
+    for ip, port in {(ip, int(port)) for ip, port in ip_ports}:
+        if org := index.voip_application(ip, port):
+            voip_apps[(ip, port)] = org
+    return voip_apps
+
+
+def migrate_network_ranges(batch_size: int = 1000) -> Dict:
+    ops, n_migrated = [], 0
+    for doc in AppDB().Networks.find({"range_st": {"$exists": False}}, {"host_addr": 1}):
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": _range_fields(doc["host_addr"])}))
+        if len(ops) >= batch_size:
+            n_migrated += AppDB().Networks.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        n_migrated += AppDB().Networks.bulk_write(ops, ordered=False).modified_count
+    invalidate_network_index()
+    return {"migrated": n_migrated}
+
 
 def _network(ip: str, belongs_to_id: str, belongs_to_name: str):
     network_ = ipaddress.ip_network(ip)
@@ -60,8 +221,9 @@ def _network(ip: str, belongs_to_id: str, belongs_to_name: str):
         # hosts=network_.hosts(),
         network_en=str(network_en),
         network_st=str(network_st),
+        **_range_fields(ip),
         belongs_to=Network.OrgRef(id=belongs_to_id, name=belongs_to_name)
     )
     AppDB().Networks.insert_one(mongo_serializer(network))
-    
+    invalidate_network_index()
 
@@ -1,26 +1,144 @@
 import math
-from typing import Dict, Union, List, Literal
+import time
+import uuid
+import threading
+import ipaddress
+from typing import Dict, Union, List, Literal, Tuple
 from datetime import datetime, timedelta
-from sqlalchemy import asc, desc, and_, or_
-from sqlalchemy.sql.operators import ilike_op
+from sqlalchemy import asc, desc, func, or_, cast, tuple_, Text
+from sqlalchemy.dialects.postgresql import INET
 
-from globals_ import sql_SessionLocal
-from models.sqlalch import NetFlow, IpEnrichment
+from globals_ import env, sql_engine, sql_SessionLocal
+from utils import to_utc, encode_cursor, decode_cursor
+from enums import TimeGranularity
+from models.sqlalch import NetFlow, TypedNetFlow, NetflowDimension, NetflowRollup, IpEnrichment
 from models import SortOrder
+from . import netflow_rollup
+from .netflow_rollup import GRANULARITIES
+from .watermarks import get_sql_watermark
 
-SearchableFields = Literal["IP", "DOMAIN", "COUNTRY", "ASN"]
+SearchableFields = Literal["IP", "DOMAIN", "COUNTRY", "ASN", "ORGANIZATION"]
+DimensionCategory = Literal["country", "asn", "application", "protocol_name"]
 
 def _get_searchable_columns(key: SearchableFields):
     if key == "IP":
-        return [NetFlow.ipv4_src_addr ,NetFlow.ipv4_dst_addr]
+        return [TypedNetFlow.ipv4_src_addr ,TypedNetFlow.ipv4_dst_addr]
     if key == "DOMAIN":
-        return [NetFlow.src_domain_name, NetFlow.dest_domain_name]
+        return [TypedNetFlow.src_domain_name, TypedNetFlow.dest_domain_name]
     if key == "COUNTRY":
-        return [NetFlow.src_country, NetFlow.dest_country]
+        return [TypedNetFlow.src_country, TypedNetFlow.dest_country]
     if key == "ASN":
-        return [NetFlow.src_asn, NetFlow.dest_asn]
+        return [TypedNetFlow.src_asn, TypedNetFlow.dest_asn]
+    if key == "ORGANIZATION":
+        return [TypedNetFlow.src_organization_name, TypedNetFlow.dest_organization_name]
     return []
 
+
+def _ip_network(val: str):
+    ## "185.22" or "185.22." is read as the 185.22.0.0/16 prefix
+    octets = val.strip().rstrip(".").split(".")
+    if len(octets) < 4 and all(o.isdigit() for o in octets):
+        val = ".".join(octets + ["0"] * (4 - len(octets))) + f"/{8 * len(octets)}"
+    try:
+        return ipaddress.ip_network(val.strip(), strict=False)
+    except ValueError:
+        return None
+
+
+def _search_cond(key: SearchableFields, column, val: str):
+    ## each field gets the operator its index can serve
+    if key == "IP":
+        if network := _ip_network(val):
+            return column.op("<<=")(cast(str(network), INET))
+        return cast(column, Text).ilike(f"%{_escape_like(val)}%", escape="\\")
+    if key in ("DOMAIN", "ORGANIZATION"):
+        ## gin trigram index
+        return column.ilike(f"%{_escape_like(val)}%", escape="\\")
+    return column == val
+
+
+def _escape_like(val: str) -> str:
+    return val.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+SEARCH_INDEXES = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    *(
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_netflow_typed_{c}_trgm "
+        f"ON netflow_typed USING gin ({c} gin_trgm_ops)"
+        for c in (
+            "src_domain_name",
+            "dest_domain_name",
+            "src_organization_name",
+            "dest_organization_name",
+        )
+    ),
+    *(
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_netflow_typed_{c} ON netflow_typed ({c})"
+        for c in ("src_country", "dest_country", "src_asn", "dest_asn")
+    ),
+]
+
+
+def create_search_indexes() -> List[str]:
+    TypedNetFlow.__table__.create(sql_engine, checkfirst=True)
+    ## CONCURRENTLY cannot run inside a transaction
+    with sql_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for stmt in SEARCH_INDEXES:
+            conn.exec_driver_sql(stmt)
+    return SEARCH_INDEXES
+
+def _netflow_columns(fields: List[str]):
+    for key in fields:
+        if key not in TypedNetFlow.__table__.columns:
+            e = f"No such field {key} in netflow data"
+            raise ValueError(e)
+    return [getattr(TypedNetFlow, key) for key in fields]
+
+
+KEYSET = (TypedNetFlow.flow_start_timestamp, TypedNetFlow.id)
+
+
+def _keyset_values(row) -> List:
+    if isinstance(row, TypedNetFlow):
+        return [getattr(row, c.key) for c in KEYSET]
+    return [row._mapping[c.key] for c in KEYSET]
+
+
+def _encode_cursor(row, sort_order: SortOrder) -> str:
+    ts, id_ = _keyset_values(row)
+    ## iso keeps the microseconds a bson date would truncate
+    return encode_cursor({"order": sort_order, "values": [ts.isoformat(), str(id_)]})
+
+
+def _seek(cursor: str, sort_order: SortOrder):
+    cursor = decode_cursor(cursor)
+    if cursor.get("order") != sort_order:
+        e = "cursor does not match the requested sort"
+        raise ValueError(e)
+    try:
+        ts, id_ = cursor["values"]
+        ts, id_ = datetime.fromisoformat(ts), uuid.UUID(id_)
+    except (TypeError, ValueError, AttributeError):
+        e = "invalid cursor"
+        raise ValueError(e)
+    keys, vals = tuple_(*KEYSET), tuple_(ts, id_)
+    return keys > vals if sort_order == "asc" else keys < vals
+
+
+def _estimated_count(session, query) -> int:
+    ## the planner's row estimate, no scan of the matching rows
+    compiled = query.order_by(None).statement.compile(
+        dialect=session.bind.dialect, compile_kwargs={"render_postcompile": True}
+    )
+    plan = (
+        session.connection()
+        .exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params)
+        .scalar()
+    )
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
 def get_netflow(
     page: int,
     limit: int,
@@ -30,106 +148,238 @@ def get_netflow(
     sort_order: SortOrder = "asc",
     date_from: datetime = None,
     date_to: datetime = None,
+    fields: Union[List[str], None] = None,
+    cursor: Union[str, None] = None,
+    exact_count: bool = False,
 ):
+    columns = None if fields is None else _netflow_columns(fields)
     session = sql_SessionLocal()
 
-    query = session.query(NetFlow)
+    query = session.query(TypedNetFlow) if columns is None else session.query(*columns)
 
     ## filters
     if filters:
         for key, vals in filters.items():
-            if not hasattr(NetFlow, key):
+            if key not in TypedNetFlow.__table__.columns:
                 e = f"No such field {key} in netflow data"
                 raise ValueError(e)
-            query = query.filter(getattr(NetFlow, key) in vals)
-
-    ## date filter
-    date_to_str = (
-        None
-        if not date_to
-        else (
-            (
-                date_to.replace(hour=0, minute=0, second=0, microsecond=0)
-                + timedelta(days=1)
-                - timedelta(seconds=1)
-            ).strftime("%Y-%m-%d %H:%M:%S")
-        )
-    )
-    date_from_str = (
-        None
-        if not date_from
-        else date_from.replace(hour=0, minute=0, second=0, microsecond=0).strftime(
-            "%Y-%m-%d %H:%M:%S"
-        )
-    )
-    if date_from and date_to:
-        query = query.filter(
-            and_(NetFlow.flow_start_timestamp) >= date_from_str,
-            NetFlow.flow_start_timestamp <= date_to_str,
+            query = query.filter(getattr(TypedNetFlow, key).in_(vals))
+
+    ## date filter, whole days in the default time zone
+    if date_from:
+        date_from = to_utc(date_from.replace(hour=0, minute=0, second=0, microsecond=0))
+        query = query.filter(TypedNetFlow.flow_start_timestamp >= date_from)
+    if date_to:
+        date_to = to_utc(
+            date_to.replace(hour=0, minute=0, second=0, microsecond=0)
+            + timedelta(days=1)
         )
-    elif date_from:
-        query = query.filter(NetFlow.flow_start_timestamp >= date_from_str)
-    elif date_to:
-        query = query.filter(NetFlow.flow_start_timestamp <= date_to_str)
+        query = query.filter(TypedNetFlow.flow_start_timestamp < date_to)
 
     ## search key
     if search_key: 
         conds = []
         for key, val in search_key.items():
             for column in _get_searchable_columns(key):
-                conds.append(ilike_op(column, f"%{val}%"))
+                conds.append(_search_cond(key, column, val))
         if conds:
             query = query.filter(or_(*conds))
 
-    total_results = query.count()
-    if total_results == 0:
-        total_pages = 0
-        page_no = page
-        per_page = 0
-        page_no = 0
-        has_prev_page = False
-        has_next_page = False
-        data = []
+    if sort_by and sort_by not in TypedNetFlow.__table__.columns:
+        e = f"No such field {sort_by} in netflow data"
+        raise ValueError(e)
+    if cursor is not None:
+        if sort_by and sort_by != "flow_start_timestamp":
+            e = "cursor pagination is only available sorted by flow_start_timestamp"
+            raise ValueError(e)
+        ## rows whose timestamp did not parse have no position in the keyset
+        query = query.filter(TypedNetFlow.flow_start_timestamp.is_not(None))
+    total_results = query.count() if exact_count else _estimated_count(session, query)
+
+    if cursor is not None:
+        if columns is not None:
+            query = query.add_columns(
+                *[c for c in KEYSET if c.key not in fields]
+            )
+        if cursor:
+            query = query.filter(_seek(cursor, sort_order))
+        direction = asc if sort_order == "asc" else desc
+        query = query.order_by(*[direction(c) for c in KEYSET])
+        page_no = None
+        has_prev_page = bool(cursor)
     else:
         if sort_by:
             query = query.order_by(
-                (asc if sort_order == "asc" else desc)(getattr(NetFlow, sort_by))
+                (asc if sort_order == "asc" else desc)(getattr(TypedNetFlow, sort_by))
             )
-        query = query.offset((page - 1) * limit).limit(limit)
-        data = query.all()
-        total_pages = math.ceil(total_results / limit)
-        page_no = page
-        per_page = min(limit, len(data))
+        query = query.offset((page - 1) * limit)
         page_no = page
         has_prev_page = page_no > 1
-        has_next_page = page_no < total_pages
 
+    data = query.limit(limit + 1).all()
     session.close()
+    has_next_page = len(data) > limit
+    data = data[:limit]
+    next_cursor = None
+    if cursor is not None and has_next_page:
+        next_cursor = _encode_cursor(data[-1], sort_order)
+    if columns is not None:
+        data = [{f: row._mapping[f] for f in fields} for row in data]
 
+    ## an estimate can undershoot what has already been paged through
+    if page_no:
+        total_results = max(total_results, (page_no - 1) * limit + len(data))
     return {
         "data": data,
+        "next_cursor": next_cursor,
         "total_results": total_results,
-        "total_pages": total_pages,
+        "total_estimated": not exact_count,
+        "total_pages": math.ceil(total_results / limit),
         "page_no": page_no,
-        "per_page": per_page,
+        "per_page": len(data),
         "has_next_page": has_next_page,
         "has_prev_page": has_prev_page,
     }
 
 
+class DimensionRegistry:
+
+    def __init__(self, poll_interval: float):
+        self._poll_interval = poll_interval
+        self._values: Dict[str, List[str]] = {}
+        self._version = None
+        self._checked_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now - self._checked_at <= self._poll_interval:
+            return
+        with self._lock:
+            if now - self._checked_at <= self._poll_interval:
+                return
+            ## the table is created by update_netflow_rollups and
+            ## rebuild_netflow_dimensions, which also set the version read here
+            session = sql_SessionLocal()
+            try:
+                version = get_sql_watermark(session, netflow_rollup.DIMENSION_JOB)
+                if version is not None and version != self._version:
+                    values = {category: [] for category in netflow_rollup.CATEGORIES}
+                    query = session.query(NetflowDimension).order_by(
+                        NetflowDimension.category, NetflowDimension.value
+                    )
+                    for row in query.all():
+                        values.setdefault(row.category, []).append(row.value)
+                    self._values = values
+                self._version = version
+            finally:
+                session.close()
+                self._checked_at = now
+
+    def get(self, category: str) -> Tuple[str | None, List[str]]:
+        if category not in netflow_rollup.CATEGORIES:
+            e = f"No such netflow dimension {category}"
+            raise ValueError(e)
+        self._refresh()
+        if self._version is None:
+            ## netflow_dimension is not built yet, no version to hand out
+            return None, _scan_dimension(category)
+        return f'"{self._version}"', self._values.get(category, [])
 
-def get_unique_countries():
+
+def _scan_dimension(category: str) -> List[str]:
     session = sql_SessionLocal()
-    query = session.query(NetFlow.src_country).distinct()
-    src_countries = [doc[0] for doc in query.all()]
-    query = session.query(NetFlow.dest_country).distinct()
-    dst_countries = [doc[0] for doc in query.all()]
+    values = set()
+    for column in netflow_rollup.CATEGORIES[category]:
+        query = session.query(getattr(NetFlow, column)).distinct()
+        values.update(doc[0] for doc in query.all())
     session.close()
-    return sorted(list(set(dst_countries+src_countries)))
+    return sorted(v for v in values if v)
+
+
+dimension_registry = DimensionRegistry(poll_interval=env.NETFLOW_DIMENSIONS_POLL_INTERVAL)
+
+
+def get_dimension_values(category: DimensionCategory) -> Tuple[str | None, List[str]]:
+    return dimension_registry.get(category)
+
+
+def get_unique_countries() -> Tuple[str | None, List[str]]:
+    return dimension_registry.get("country")
+
+
+RollupDimension = Literal[
+    "src_country",
+    "dest_country",
+    "src_asn",
+    "dest_asn",
+    "application",
+    "protocol_name",
+    "is_suspicious",
+]
+Granularity = Literal["HOUR", "DAY", "MONTH"]
+
+
+def _bucket_start(granularity: Granularity, ts: datetime):
+    unit = GRANULARITIES[granularity]
+    return func.timezone("UTC", func.date_trunc(unit, func.timezone("UTC", ts)))
+
+
+def get_frequency_maps(
+    dimension: RollupDimension,
+    granularity: Granularity = TimeGranularity.day,
+    date_from: datetime = None,
+    date_to: datetime = None,
+    limit: int = 10,
+):
+    ## served from netflow_rollup only, never from the flow tables
+    conds = [
+        NetflowRollup.granularity == granularity,
+        NetflowRollup.dimension == dimension,
+    ]
+    if date_from:
+        date_from = to_utc(date_from.replace(hour=0, minute=0, second=0, microsecond=0))
+        conds.append(NetflowRollup.bucket >= _bucket_start(granularity, date_from))
+    if date_to:
+        date_to = to_utc(
+            date_to.replace(hour=0, minute=0, second=0, microsecond=0)
+            + timedelta(days=1)
+        )
+        conds.append(NetflowRollup.bucket < date_to)
 
-def get_frequency_maps(field: str=None, key: SearchableFields=None):
     session = sql_SessionLocal()
-    
+    flows = func.sum(NetflowRollup.flows).label("flows")
+    top = (
+        session.query(
+            NetflowRollup.value,
+            func.sum(NetflowRollup.bytes).label("bytes"),
+            func.sum(NetflowRollup.packets).label("packets"),
+            flows,
+        )
+        .filter(*conds)
+        .group_by(NetflowRollup.value)
+        .order_by(desc(flows))
+        .limit(limit)
+        .all()
+    )
+    series = (
+        session.query(NetflowRollup)
+        .filter(*conds, NetflowRollup.value.in_([row.value for row in top]))
+        .order_by(NetflowRollup.bucket)
+        .all()
+    )
     session.close()
-    return 
 
+    buckets = {}
+    for row in series:
+        buckets.setdefault(row.bucket, {})[row.value] = {
+            "bytes": row.bytes,
+            "packets": row.packets,
+            "flows": row.flows,
+        }
+    return {
+        "dimension": dimension,
+        "granularity": granularity,
+        "top": [dict(row._mapping) for row in top],
+        "buckets": [{"bucket": bucket, "values": values} for bucket, values in buckets.items()],
+    }
@@ -0,0 +1,129 @@
+import uuid
+import zlib
+from typing import Dict
+
+from sqlalchemy import func, text
+
+from enums import TimeGranularity
+from globals_ import sql_engine, sql_SessionLocal
+from models.sqlalch import NetflowDimension, NetflowRollup, TypedNetFlow
+from .watermarks import get_sql_watermark, set_sql_watermark
+
+JOB = "netflow_rollup"
+LOCK_KEY = zlib.crc32(JOB.encode("utf-8"))
+## version of netflow_dimension, bumped by every write that changes it
+DIMENSION_JOB = "netflow_dimension"
+
+GRANULARITIES = {
+    TimeGranularity.hour: "hour",
+    TimeGranularity.day: "day",
+    TimeGranularity.month: "month",
+}
+
+DIMENSIONS = (
+    "src_country",
+    "dest_country",
+    "src_asn",
+    "dest_asn",
+    "application",
+    "protocol_name",
+    "is_suspicious",
+)
+
+## filter dropdown values, each category merges the columns listed
+CATEGORIES = {
+    "country": ("src_country", "dest_country"),
+    "asn": ("src_asn", "dest_asn"),
+    "application": ("application",),
+    "protocol_name": ("protocol_name",),
+}
+
+_dimension_values = ", ".join(f"('{d}', n.{d}::text)" for d in DIMENSIONS)
+_granularity_values = ", ".join(f"('{g}', '{unit}')" for g, unit in GRANULARITIES.items())
+_category_values = ", ".join(
+    f"('{c}', n.{column}::text)" for c, columns in CATEGORIES.items() for column in columns
+)
+
+## folds every flow of a seq window into each (granularity, dimension) rollup
+ROLLUP_SQL = text(
+    f"""
+    INSERT INTO {NetflowRollup.__tablename__}
+        (granularity, dimension, bucket, value, bytes, packets, flows)
+    SELECT
+        g.granularity,
+        d.dimension,
+        date_trunc(g.unit, n.flow_start_timestamp AT TIME ZONE 'UTC') AT TIME ZONE 'UTC',
+        coalesce(d.value, ''),
+        sum(coalesce(n.in_bytes, 0) + coalesce(n.out_bytes, 0)),
+        sum(coalesce(n.in_pkts, 0) + coalesce(n.out_pkts, 0)),
+        count(*)
+    FROM {TypedNetFlow.__tablename__} n
+    CROSS JOIN (VALUES {_granularity_values}) g(granularity, unit)
+    CROSS JOIN LATERAL (VALUES {_dimension_values}) d(dimension, value)
+    WHERE n.seq > :lower AND n.seq <= :upper AND n.flow_start_timestamp IS NOT NULL
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (granularity, dimension, bucket, value) DO UPDATE SET
+        bytes = {NetflowRollup.__tablename__}.bytes + excluded.bytes,
+        packets = {NetflowRollup.__tablename__}.packets + excluded.packets,
+        flows = {NetflowRollup.__tablename__}.flows + excluded.flows
+    """
+)
+
+## records values of a seq window not seen before
+DIMENSION_SQL = text(
+    f"""
+    INSERT INTO {NetflowDimension.__tablename__} (category, value)
+    SELECT DISTINCT d.category, d.value
+    FROM {TypedNetFlow.__tablename__} n
+    CROSS JOIN LATERAL (VALUES {_category_values}) d(category, value)
+    WHERE n.seq > :lower AND n.seq <= :upper AND coalesce(d.value, '') <> ''
+    ON CONFLICT (category, value) DO NOTHING
+    """
+)
+
+
+def _lock(session):
+    ## the fold is additive, overlapping runs must not read the same
+    ## watermark, the lock is released by the window's commit
+    session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": LOCK_KEY})
+
+
+def update_netflow_rollups(batch_size: int = 1000000) -> Dict:
+    NetflowRollup.__table__.create(sql_engine, checkfirst=True)
+    NetflowDimension.__table__.create(sql_engine, checkfirst=True)
+    session = sql_SessionLocal()
+    upper = session.query(func.max(TypedNetFlow.seq)).scalar() or 0
+
+    n_windows = 0
+    while True:
+        _lock(session)
+        ## re-read inside the window's transaction, another run may have moved it
+        watermark = int(get_sql_watermark(session, JOB) or 0)
+        if watermark >= upper:
+            session.rollback()
+            break
+        window_en = min(watermark + batch_size, upper)
+        session.execute(ROLLUP_SQL, {"lower": watermark, "upper": window_en})
+        if session.execute(DIMENSION_SQL, {"lower": watermark, "upper": window_en}).rowcount:
+            set_sql_watermark(session, DIMENSION_JOB, uuid.uuid4().hex, commit=False)
+        ## commits the window and its watermark together, so a crash can
+        ## never count a window twice
+        set_sql_watermark(session, JOB, str(window_en))
+        n_windows += 1
+
+    session.close()
+    return {"watermark": watermark, "windows": n_windows}
+
+
+def rebuild_netflow_dimensions() -> Dict:
+    ## backfills the values of windows rolled up before the table existed
+    NetflowDimension.__table__.create(sql_engine, checkfirst=True)
+    session = sql_SessionLocal()
+    _lock(session)
+    watermark = int(get_sql_watermark(session, JOB) or 0)
+    session.query(NetflowDimension).delete()
+    session.execute(DIMENSION_SQL, {"lower": 0, "upper": watermark})
+    set_sql_watermark(session, DIMENSION_JOB, uuid.uuid4().hex)
+    n_values = session.query(NetflowDimension).count()
+    session.close()
+    return {"watermark": watermark, "values": n_values}
@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta
+from typing import Dict
+
+from sqlalchemy import BigInteger, Boolean, DateTime, Numeric, case, cast, func, select
+from sqlalchemy.dialects.postgresql import INET, insert
+
+from globals_ import env, sql_engine, sql_SessionLocal
+from models.sqlalch import NetFlow, TypedNetFlow
+from .watermarks import get_sql_watermark, set_sql_watermark
+
+JOB = "netflow_typed"
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+## the guards are as strict as the casts they protect, a value that passes
+## always casts, so one bad row becomes NULL instead of failing the window
+BIGINT = r"^\s*-?[0-9]{1,18}(\.[0-9]+)?\s*$"
+NUMBER = r"^\s*-?[0-9]+(\.[0-9]+)?([eE][-+]?[0-9]{1,3})?\s*$"
+OCTET = r"(25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])"
+IPV4 = rf"^\s*({OCTET}\.){{3}}{OCTET}\s*$"
+_MONTH_DAY = (
+    r"(0[1-9]|1[0-2])-(0[1-9]|1[0-9]|2[0-8])"
+    r"|(0[13-9]|1[0-2])-(29|30)"
+    r"|(0[13578]|1[02])-31"
+)
+_LEAP_DAY = r"([1-9][0-9](0[48]|[2468][048]|[13579][26])|([2468][048]|[13579][26])00)-02-29"
+TIMESTAMP = (
+    rf"^([1-9][0-9]{{3}}-({_MONTH_DAY})|{_LEAP_DAY})"
+    r"[ T]([01][0-9]|2[0-3]):[0-5][0-9]:[0-5][0-9](\.[0-9]{1,6})?"
+    r"(Z|[+-][0-9]{2}(:?[0-9]{2})?)?\s*$"
+)
+TRUE_VALUES = ("true", "t", "1", "yes", "y")
+FALSE_VALUES = ("false", "f", "0", "no", "n")
+
+
+def _typed(column, type_):
+    ## raw values that do not parse become NULL instead of failing the batch
+    raw = getattr(NetFlow, column.name)
+    if isinstance(type_, BigInteger):
+        return case((raw.regexp_match(BIGINT), cast(cast(raw, Numeric()), BigInteger())))
+    if isinstance(type_, Numeric):
+        return case((raw.regexp_match(NUMBER), cast(raw, Numeric())))
+    if isinstance(type_, INET):
+        return case((raw.regexp_match(IPV4), cast(func.trim(raw), INET())))
+    if isinstance(type_, DateTime):
+        ## refined_netflow keeps naive timestamps in the default time zone
+        return case(
+            (
+                raw.regexp_match(TIMESTAMP),
+                func.timezone(env.DEFAULT_TIME_ZONE.zone, cast(raw, DateTime())),
+            )
+        )
+    if isinstance(type_, Boolean):
+        return case(
+            (func.lower(func.trim(raw)).in_(TRUE_VALUES), True),
+            (func.lower(func.trim(raw)).in_(FALSE_VALUES), False),
+        )
+    return raw
+
+
+def _shift(ts: str, delta: timedelta) -> str:
+    ## TIMESTAMP also accepts an ISO "T" separator
+    ts = ts.strip()[:19].replace("T", " ")
+    return (datetime.strptime(ts, TIMESTAMP_FORMAT) + delta).strftime(TIMESTAMP_FORMAT)
+
+
+def _sync_stmt(lower: str | None, upper: str):
+    columns = [c for c in TypedNetFlow.__table__.columns if c.name != "seq"]
+    conds = [NetFlow.flow_start_timestamp <= upper]
+    if lower:
+        conds.append(NetFlow.flow_start_timestamp > lower)
+    rows = select(*[_typed(c, c.type) for c in columns]).where(*conds)
+    stmt = insert(TypedNetFlow).from_select([c.name for c in columns], rows)
+    return stmt.on_conflict_do_nothing(index_elements=[TypedNetFlow.id])
+
+
+def sync_typed_netflow(window_hours: int = 24, lag_minutes: int = 60) -> Dict:
+    TypedNetFlow.__table__.create(sql_engine, checkfirst=True)
+    session = sql_SessionLocal()
+    watermark = get_sql_watermark(session, JOB)
+    ## bounds only over real timestamps, "" or "N/A" would sort below or above
+    ## every date and turn the window walk into a crash or an endless loop
+    is_timestamp = NetFlow.flow_start_timestamp.regexp_match(TIMESTAMP)
+    upper = session.query(func.max(NetFlow.flow_start_timestamp)).filter(is_timestamp).scalar()
+    if upper is None or (watermark and upper <= watermark):
+        session.close()
+        return {"watermark": watermark, "synced": 0}
+
+    ## flows are not always written in timestamp order, so each run re-reads
+    ## the last lag_minutes and relies on the id conflict to skip known rows
+    if watermark:
+        lower = _shift(watermark, timedelta(minutes=-lag_minutes))
+    else:
+        lower = (
+            session.query(func.min(NetFlow.flow_start_timestamp)).filter(is_timestamp).scalar()
+        )
+        lower = _shift(lower, timedelta(seconds=-1))
+
+    n_synced = 0
+    while lower < upper:
+        ## one transaction per window keeps the first backfill bounded
+        window_en = min(_shift(lower, timedelta(hours=window_hours)), upper)
+        n_synced += session.execute(_sync_stmt(lower, window_en)).rowcount
+        set_sql_watermark(session, JOB, window_en)
+        lower = window_en
+
+    session.close()
+    return {"watermark": upper, "synced": n_synced}
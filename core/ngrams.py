@@ -0,0 +1,111 @@
+from collections import Counter
+from typing import Dict, Iterable, List, Set
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from database import AppDB, INDEXES
+from utils import curr_time
+from .cache import MISSING, TTLCache
+from .watermarks import get_mongo_watermark, set_mongo_watermark
+
+JOB = "iocs_v3_ngrams"
+N = 3
+MAX_CANDIDATES = 100000
+## the listing and its count resolve the same search_key back to back
+candidates_cache = TTLCache(maxsize=256, ttl=60)
+
+
+def ngrams(s: str) -> Set[str]:
+    return {s[i : i + N] for i in range(len(s) - N + 1)}
+
+
+def add_iocs(iocs_: Iterable[str], chunk_size: int = 10000):
+    postings = []
+    for ioc in iocs_:
+        postings.extend({"g": g, "ioc": ioc} for g in ngrams(ioc))
+        if len(postings) >= chunk_size:
+            _write(postings)
+            postings = []
+    _write(postings)
+
+
+def _write(postings: List[Dict]):
+    if not postings:
+        return
+    failed = set()
+    try:
+        AppDB().IOCsV3Ngrams.insert_many(postings, ordered=False)
+    except BulkWriteError as e:
+        ## postings of an ioc added again are harmless, anything else is not
+        if any(err["code"] != 11000 for err in e.details["writeErrors"]):
+            raise
+        failed = {err["index"] for err in e.details["writeErrors"]}
+    ## only postings actually inserted count towards the gram frequency
+    counts = Counter(p["g"] for i, p in enumerate(postings) if i not in failed)
+    if not counts:
+        return
+    AppDB().IOCsV3NgramCounts.bulk_write(
+        [UpdateOne({"_id": g}, {"$inc": {"n": n}}, upsert=True) for g, n in counts.items()],
+        ordered=False,
+    )
+
+
+def invalidate():
+    ## searches fall back to the regex scan until the next rebuild completes
+    AppDB().JobState.delete_one({"_id": JOB})
+    candidates_cache.clear()
+
+
+def rebuild_ioc_ngrams() -> Dict:
+    invalidate()
+    AppDB().IOCsV3Ngrams.drop()
+    AppDB().IOCsV3NgramCounts.drop()
+    AppDB().IOCsV3Ngrams.create_indexes(INDEXES["IOCsV3Ngrams"])
+    iocs_ = (doc["_id"] for doc in AppDB().IOCsV3Cahe.find({}, {"_id": 1}).batch_size(10000))
+    add_iocs(iocs_)
+    set_mongo_watermark(JOB, curr_time())
+    candidates_cache.clear()
+    return {
+        "postings": AppDB().IOCsV3Ngrams.estimated_document_count(),
+        "ngrams": AppDB().IOCsV3NgramCounts.estimated_document_count(),
+    }
+
+
+def _search_candidates(search_key: str) -> List[str] | None:
+    grams = ngrams(search_key)
+    if not grams or not get_mongo_watermark(JOB):
+        return None
+    counts = {
+        doc["_id"]: doc["n"]
+        for doc in AppDB().IOCsV3NgramCounts.find({"_id": {"$in": list(grams)}})
+    }
+    if len(counts) < len(grams):
+        ## postings are complete, so a gram nobody has means no match
+        return []
+    grams = sorted(grams, key=counts.get)
+    if counts[grams[0]] > MAX_CANDIDATES:
+        return None
+    ## start from the rarest posting list and only probe the others with it
+    candidates = {
+        doc["ioc"]
+        for doc in AppDB().IOCsV3Ngrams.find({"g": grams[0]}, {"_id": 0, "ioc": 1})
+    }
+    for g in grams[1:]:
+        if not candidates:
+            break
+        candidates = {
+            doc["ioc"]
+            for doc in AppDB().IOCsV3Ngrams.find(
+                {"g": g, "ioc": {"$in": list(candidates)}}, {"_id": 0, "ioc": 1}
+            )
+        }
+    return sorted(candidates)
+
+
+def search_candidates(search_key: str) -> List[str] | None:
+    candidates = candidates_cache.get(search_key)
+    if candidates is MISSING:
+        candidates = _search_candidates(search_key)
+        candidates_cache.set(search_key, candidates)
+    return candidates
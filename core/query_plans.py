@@ -0,0 +1,150 @@
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+from bson import ObjectId
+
+from database import AppDB
+from enums import IOCType, SourceType
+from utils import mongo_serializer, curr_time
+from . import iocs, asn, geo, ipdr
+
+SAMPLE_IOC = "example.com"
+SAMPLE_SOURCE = "example.org"
+SAMPLE_PREFIX = "1.2.0.0"
+SAMPLE_DAY = datetime(2025, 1, 1)
+
+
+def canonical_queries() -> List[Tuple[str, str, List[Dict]]]:
+    date_from, date_to = SAMPLE_DAY, SAMPLE_DAY + timedelta(days=7)
+    return [
+        ("iocs.ioc_lookup", "IOCs", iocs.ioc_lookup_pipeline(IOCType.domain, SAMPLE_IOC)),
+        ("iocs.ioc_lookups", "IOCs", iocs.ioc_lookups_pipeline(IOCType.domain, [SAMPLE_IOC])),
+        ("iocs.get_iocs", "IOCs", iocs._iocs_match(IOCType.domain, {}, date_from, date_to)),
+        (
+            "iocs.get_iocs_v2 source",
+            "IOCsV3Cahe",
+            iocs._iocs_v2_match(None, {"source": [SAMPLE_SOURCE]}),
+        ),
+        (
+            "iocs.get_iocs_v2 threat_type",
+            "IOCsV3Cahe",
+            iocs._iocs_v2_match(None, {"threat_type": ["MALWARE"]}),
+        ),
+        (
+            "iocs.get_iocs_v2 type_",
+            "IOCsV3Cahe",
+            iocs._iocs_v2_match(None, {"type_": [IOCType.domain]}),
+        ),
+        (
+            "iocs.get_iocs_v2 dates",
+            "IOCsV3Cahe",
+            iocs._iocs_v2_match(None, {}, date_from, date_to),
+        ),
+        (
+            "iocs.count_iocs_v2",
+            "IOCsV3Counts",
+            [{"$match": {"dim": "source", "value": {"$in": [SAMPLE_SOURCE]}}}],
+        ),
+        ("ngrams.search_candidates", "IOCsV3Ngrams", [{"$match": {"g": SAMPLE_IOC[:3]}}]),
+        ("geo.get_locations", "GeoLocation", [{"$match": geo.locations_query([SAMPLE_PREFIX])}]),
+        ("asn.get_asn_infos", "ASNRecords", asn.asn_infos_pipeline([SAMPLE_PREFIX])),
+        (
+            "ipdr.find_networks",
+            "Networks",
+            [{"$match": {"ip_version": 4, "range_st": {"$in": [16908288]}, "range_en": {"$gte": 16908289}}}],
+        ),
+        (
+            "sources.get_source",
+            "IOCSources",
+            [{"$match": {"type": SourceType.feed, "key": SAMPLE_SOURCE}}],
+        ),
+    ]
+
+
+def _seed_docs() -> Dict[str, List[Dict]]:
+    source_ref = {"key": SAMPLE_SOURCE, "type": SourceType.feed, "attr": {"threat_type": "MALWARE"}}
+    return {
+        "IOCs": [
+            {
+                "keys": {IOCType.domain.value: [SAMPLE_IOC]},
+                "ioc_types": [IOCType.domain],
+                "source_ref": source_ref,
+                "created_at": curr_time(),
+            }
+        ],
+        "IOCsV3": [
+            {"_id": ObjectId(), "ioc": SAMPLE_IOC, "type_": IOCType.domain, "source_ref": source_ref}
+        ],
+        "IOCsV3Cahe": [
+            {
+                "_id": SAMPLE_IOC,
+                "type_": IOCType.domain,
+                "sources_ref": [source_ref],
+                "first_found_at": curr_time(),
+                "last_found_at": curr_time(),
+                "no_occurrences": 1,
+                "no_sources": 1,
+            }
+        ],
+        "IOCsV3Counts": [{"dim": "source", "value": SAMPLE_SOURCE, "day": SAMPLE_DAY, "count": 1}],
+        "IOCsV3Ngrams": [{"g": SAMPLE_IOC[:3], "ioc": SAMPLE_IOC}],
+        "IOCSources": [{"type": SourceType.feed, "key": SAMPLE_SOURCE, "created_at": curr_time()}],
+        "Networks": [{"host_addr": "1.2.0.0/16", **ipdr._range_fields("1.2.0.0/16")}],
+        "GeoLocation": [{"ipv4": SAMPLE_PREFIX}],
+        "ASNRecords": [{"ipv4": SAMPLE_PREFIX}],
+    }
+
+
+def seed_collections():
+    ## only meant for a throwaway mongod, empty collections explain as EOF
+    for name, docs in _seed_docs().items():
+        collection = getattr(AppDB(), name)
+        if collection.estimated_document_count() == 0:
+            collection.insert_many(mongo_serializer(docs))
+
+
+def _plan_stages(node) -> List[str]:
+    if isinstance(node, list):
+        return [stage for n in node for stage in _plan_stages(n)]
+    if not isinstance(node, dict):
+        return []
+    stages = [node["stage"]] if isinstance(node.get("stage"), str) else []
+    ## a $lookup lowered into the query plan, only IndexedLoopJoin probes an index
+    if node.get("stage") == "EQ_LOOKUP" and node.get("strategy") != "IndexedLoopJoin":
+        stages.append("COLLSCAN")
+    ## a $lookup run by the pipeline, its sub plans only show up in execution stats
+    if "$lookup" in node:
+        stages.append("$lookup")
+        if node.get("collectionScans"):
+            stages.append("COLLSCAN")
+        stages.extend("IXSCAN" for _ in node.get("indexesUsed", []))
+    for k, v in node.items():
+        if k in ("winningPlan", "queryPlan", "inputStage", "inputStages", "stages", "$cursor", "queryPlanner"):
+            stages.extend(_plan_stages(v))
+    return stages
+
+
+def explain(name: str, pipeline: List[Dict]) -> List[str]:
+    collection = getattr(AppDB(), name)
+    res = collection.database.command(
+        {
+            "explain": {
+                "aggregate": collection.name,
+                "pipeline": mongo_serializer(pipeline),
+                "cursor": {},
+            },
+            ## execution stats run the pipeline, only needed to see $lookup sub plans
+            "verbosity": (
+                "executionStats" if any("$lookup" in stage for stage in pipeline) else "queryPlanner"
+            ),
+        }
+    )
+    return _plan_stages(res)
+
+
+def check_query_plans() -> Dict:
+    plans = {query: explain(name, pipeline) for query, name, pipeline in canonical_queries()}
+    return {
+        "plans": plans,
+        "collscans": [query for query, stages in plans.items() if "COLLSCAN" in stages],
+    }
@@ -0,0 +1,182 @@
+import os
+import mmap
+import time
+import struct
+import threading
+import ipaddress
+from typing import Any, Dict, Iterable, List, Tuple
+
+## file layout
+##   header | slot index (65536 x u32) | records | extra (u32 array)
+##   | string offsets ((n_strings + 1) x u32) | string bytes (utf-8)
+## a slot holds the record number of the /16 it belongs to or NONE
+
+MAGIC = b"IOCS"
+FORMAT_VERSION = 1
+NONE = 0xFFFFFFFF
+N_SLOTS = 1 << 16
+
+_HEADER = struct.Struct("<4s4sHHQIIII")
+_U32 = struct.Struct("<I")
+
+
+def slot(ip: str) -> int | None:
+    ## None for anything that is not an ipv4 address, 300.1.1.1 included
+    try:
+        packed = ipaddress.IPv4Address(ip).packed
+    except (TypeError, ValueError):
+        return None
+    return (packed[0] << 8) | packed[1]
+
+
+class SnapshotWriter:
+
+    def __init__(self, kind: bytes, record_format: str):
+        self._kind = kind
+        self._record = struct.Struct(record_format)
+        self._slots = [NONE] * N_SLOTS
+        self._records: List[bytes] = []
+        self._extra: List[int] = []
+        self._strings: Dict[str, int] = {}
+
+    def string(self, val: str | None) -> int:
+        if val is None:
+            return NONE
+        if val not in self._strings:
+            self._strings[val] = len(self._strings)
+        return self._strings[val]
+
+    def extra(self, vals: Iterable[int]) -> Tuple[int, int]:
+        start = len(self._extra)
+        self._extra.extend(vals)
+        return start, len(self._extra) - start
+
+    def put(self, ip: str, *record: Any) -> bool:
+        i = slot(ip)
+        if i is None or self._slots[i] != NONE:
+            return False
+        self._slots[i] = len(self._records)
+        self._records.append(self._record.pack(*record))
+        return True
+
+    def write(self, path: str) -> int:
+        version = int(time.time() * 1000)
+        strings = [s.encode("utf-8") for s in self._strings]
+        offsets = [0]
+        for s in strings:
+            offsets.append(offsets[-1] + len(s))
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(
+                _HEADER.pack(
+                    MAGIC,
+                    self._kind,
+                    FORMAT_VERSION,
+                    self._record.size,
+                    version,
+                    len(self._records),
+                    len(self._extra),
+                    len(strings),
+                    offsets[-1],
+                )
+            )
+            f.write(struct.pack(f"<{N_SLOTS}I", *self._slots))
+            f.write(b"".join(self._records))
+            f.write(struct.pack(f"<{len(self._extra)}I", *self._extra))
+            f.write(struct.pack(f"<{len(offsets)}I", *offsets))
+            f.write(b"".join(strings))
+        ## readers keep the old mapping until they notice the new file
+        os.replace(tmp_path, path)
+        return version
+
+
+class Snapshot:
+
+    def __init__(self, path: str, kind: bytes, record_format: str):
+        self.path = path
+        self._record = struct.Struct(record_format)
+        with open(path, "rb") as f:
+            self.mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._buf) < _HEADER.size:
+            e = f"{path} is truncated"
+            raise ValueError(e)
+        (
+            magic,
+            kind_,
+            format_version,
+            record_size,
+            self.version,
+            n_records,
+            n_extra,
+            n_strings,
+            n_string_bytes,
+        ) = _HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC or kind_ != kind or format_version != FORMAT_VERSION:
+            e = f"{path} is not a {kind.decode()} snapshot of format version {FORMAT_VERSION}"
+            raise ValueError(e)
+        if record_size != self._record.size:
+            e = f"{path} has records of {record_size} bytes, expected {self._record.size}"
+            raise ValueError(e)
+        self._slots_at = _HEADER.size
+        self._records_at = self._slots_at + N_SLOTS * _U32.size
+        self._extra_at = self._records_at + n_records * record_size
+        self._offsets_at = self._extra_at + n_extra * _U32.size
+        self._strings_at = self._offsets_at + (n_strings + 1) * _U32.size
+        if len(self._buf) != self._strings_at + n_string_bytes:
+            e = f"{path} is truncated"
+            raise ValueError(e)
+
+    def get(self, ip: str) -> Tuple | None:
+        if (slot_ := slot(ip)) is None:
+            return None
+        (i,) = _U32.unpack_from(self._buf, self._slots_at + slot_ * _U32.size)
+        if i == NONE:
+            return None
+        return self._record.unpack_from(self._buf, self._records_at + i * self._record.size)
+
+    def string(self, i: int) -> str | None:
+        if i == NONE:
+            return None
+        st, en = struct.unpack_from("<II", self._buf, self._offsets_at + i * _U32.size)
+        return self._buf[self._strings_at + st : self._strings_at + en].decode("utf-8")
+
+    def extra(self, start: int, count: int) -> Tuple[int, ...]:
+        return struct.unpack_from(f"<{count}I", self._buf, self._extra_at + start * _U32.size)
+
+
+class SnapshotHandle:
+
+    def __init__(self, path: str, kind: bytes, record_format: str, check_interval: float = 30):
+        self._path = path
+        self._kind = kind
+        self._record_format = record_format
+        self._check_interval = check_interval
+        self._checked_at = float("-inf")
+        self._snapshot: Snapshot | None = None
+        self._lock = threading.Lock()
+
+    def _reload(self):
+        try:
+            mtime_ns = os.stat(self._path).st_mtime_ns
+        except FileNotFoundError:
+            self._snapshot = None
+            return
+        if self._snapshot is None or self._snapshot.mtime_ns != mtime_ns:
+            try:
+                self._snapshot = Snapshot(self._path, self._kind, self._record_format)
+            except (OSError, ValueError, struct.error) as e:
+                ## keeps serving the previous snapshot, without one callers
+                ## fall back to mongo
+                print(f"could not load snapshot {self._path}: {e}")
+
+    def get(self) -> Snapshot | None:
+        now = time.monotonic()
+        if now - self._checked_at > self._check_interval:
+            with self._lock:
+                if now - self._checked_at > self._check_interval:
+                    try:
+                        self._reload()
+                    finally:
+                        self._checked_at = now
+        return self._snapshot
@@ -1,12 +1,18 @@
+import time
+import threading
 from uuid import uuid4
 from datetime import datetime
 from urllib.parse import urlparse
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 from database import AppDB
-from typing import Any
+from typing import Any, Dict, List, Tuple
 from enums import IOCType, SourceType
 from models import IOCFinding, SourceRef, SourceTypeVar, create_source
 from utils import mongo_serializer, curr_time
+from globals_ import env
+from . import iocs
 
 
 def get_git_user_repo(url: str):
@@ -94,18 +100,100 @@ def _normalized_source(doc) -> SourceTypeVar:
     return create_source(source)
 
 
+class SourceRegistry:
+
+    def __init__(self, poll_interval: float):
+        self._poll_interval = poll_interval
+        self._sources: Dict[Tuple[SourceType, str], SourceTypeVar] = {}
+        self._version = None
+        self._checked_at = float("-inf")
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _get_version(cls):
+        ## inserts move the count and max _id, in place updates move updated_at
+        latest = AppDB().IOCSources.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        updated = AppDB().IOCSources.find_one(
+            {}, {"_id": 0, "updated_at": 1}, sort=[("updated_at", -1)]
+        )
+        return (
+            AppDB().IOCSources.estimated_document_count(),
+            None if not latest else latest["_id"],
+            None if not updated else updated.get("updated_at"),
+        )
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now - self._checked_at <= self._poll_interval:
+            return
+        with self._lock:
+            if now - self._checked_at <= self._poll_interval:
+                return
+            version = self._get_version()
+            if version != self._version:
+                sources = map(create_source, AppDB().IOCSources.find({}))
+                self._sources = {(s.type, s.key): s for s in sources}
+                self._version = version
+            self._checked_at = now
+
+    def get(self, type_: SourceType, key: str) -> SourceTypeVar | None:
+        self._refresh()
+        return self._sources.get((SourceType(type_), key))
+
+    def put(self, source: SourceTypeVar):
+        self._sources = {**self._sources, (source.type, source.key): source}
+
+    def keys(self) -> List[str]:
+        self._refresh()
+        return list(dict.fromkeys(key for _, key in self._sources))
+
+
+source_registry = SourceRegistry(poll_interval=env.SOURCE_REGISTRY_POLL_INTERVAL)
+
+
 def get_source(type_: SourceType, key: str) -> SourceTypeVar | None:
+    if source := source_registry.get(type_, key):
+        return source
+    ## the registry may not have polled a source added by another process yet
     source = AppDB().IOCSources.find_one(mongo_serializer({"type": type_, "key": key}))
-    print(source, mongo_serializer({"type": type_, "key": key}))
     source = None if not source else create_source(source)
+    if source:
+        source_registry.put(source)
     return source
 
 
 def add_source(source: SourceTypeVar):
-    if ex := get_source(source.type, source.key):
+    if ex := source_registry.get(source.type, source.key):
         return ex
-    source.created_at = curr_time()
-    AppDB().IOCSources.insert_one(mongo_serializer(source))
+    source.created_at = source.updated_at = curr_time()
+    doc = mongo_serializer(source)
+    query = {"type": doc["type"], "key": doc["key"]}
+    try:
+        doc = AppDB().IOCSources.find_one_and_update(
+            query,
+            {"$setOnInsert": doc},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        ## lost the upsert race against a concurrent insert of the same source
+        doc = AppDB().IOCSources.find_one(query)
+    source = create_source(doc)
+    source_registry.put(source)
+    return source
+
+
+def update_source(type_: SourceType, key: str, update: Dict) -> SourceTypeVar | None:
+    ## every write bumps updated_at, that is what other registries poll for
+    doc = AppDB().IOCSources.find_one_and_update(
+        mongo_serializer({"type": type_, "key": key}),
+        {"$set": mongo_serializer({**update, "updated_at": curr_time()})},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not doc:
+        return None
+    source = create_source(doc)
+    source_registry.put(source)
     return source
 
 
@@ -116,34 +204,12 @@ def normalize_source(ioc_finding: IOCFinding):
 
 
 def get_ioc_sources(type_: IOCType, ioc: Any):
-
-    sources_refs = AppDB().IOCs.aggregate(
-        [
-            {"$match": {f"keys.{type_.value}": ioc}},
-            {"$group": {"_id": None, "source_refs": {"$addToSet": "$source_ref"}}},
-        ]
-    )
-    sources_refs = list(sources_refs)
-    sources_refs = (
-        [] if len(sources_refs) == 0 else sources_refs[0].get("source_refs", [])
-    )
-    sources_refs = list(map(SourceRef, sources_refs))
-
-    return list(map(lambda s: get_source(s.type, s.key), sources_refs))
-    # if ioc_finding.source_ref:
-    #     return get_source(ioc_finding.source_ref.type, ioc_finding.source_ref.key)
-
-    # return normalize_source(ioc_finding)
+    lookup = iocs.ioc_lookup(type_=type_, ioc=ioc)
+    return [] if not lookup else lookup["resolved_sources"]
 
 
 def get_source_keys():
-    res = AppDB().IOCSources.aggregate(
-        [{"$group": {"_id": "", "sources": {"$addToSet": "$key"}}}]
-    )
-    res = list(res)
-    if len(res)>0:
-        return res[0]["sources"]
-    return []
+    return source_registry.keys()
 
 def get_threat_types():
     # res = AppDB().IOCSources.aggregate(
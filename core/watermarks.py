@@ -0,0 +1,37 @@
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert
+
+from database import AppDB
+from globals_ import sql_engine
+from models.sqlalch import JobWatermark
+from utils import curr_time
+
+
+def get_sql_watermark(session: Session, job: str) -> str | None:
+    JobWatermark.__table__.create(sql_engine, checkfirst=True)
+    ## always read from the database, never from the session's identity map
+    return session.query(JobWatermark.value).filter(JobWatermark.job == job).scalar()
+
+
+def set_sql_watermark(session: Session, job: str, value: str, commit: bool = True):
+    stmt = insert(JobWatermark).values(job=job, value=value, updated_at=curr_time())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[JobWatermark.job],
+        set_={"value": stmt.excluded.value, "updated_at": stmt.excluded.updated_at},
+    )
+    session.execute(stmt)
+    if commit:
+        session.commit()
+
+
+def get_mongo_watermark(job: str):
+    watermark = AppDB().JobState.find_one({"_id": job})
+    return None if not watermark else watermark["value"]
+
+
+def set_mongo_watermark(job: str, value):
+    AppDB().JobState.update_one(
+        {"_id": job},
+        {"$set": {"value": value, "updated_at": curr_time()}},
+        upsert=True,
+    )
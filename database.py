@@ -1,6 +1,9 @@
-from pymongo import MongoClient
+from typing import Dict, List
+from pymongo import MongoClient, AsyncMongoClient, IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import PyMongoError
 from bson.codec_options import CodecOptions
 
+from enums import IOCType
 from globals_ import env
 
 codec_options = CodecOptions(tz_aware=True)
@@ -27,7 +30,52 @@ class DBConnection(CustomMongoClient):
         return cls._instance
 
 
-class AppDB(DBConnection):
+class AppCollections:
+
+    def _init_collections(self):
+        self._database = env.APP_DB_NAME
+        self.IOCs = self[self._database].get_collection(
+            "iocs", codec_options
+        )
+        self.IOCsV2 = self[self._database].get_collection(
+            "iocs_v2", codec_options
+        )
+        self.IOCsV3 = self[self._database].get_collection(
+            "iocs_v3", codec_options
+        )
+        self.IOCsV3Cahe = self[self._database].get_collection(
+            "iocs_v3_cache", codec_options
+        )
+        self.IOCsV3Counts = self[self._database].get_collection(
+            "iocs_v3_counts", codec_options
+        )
+        self.IOCsV3Ngrams = self[self._database].get_collection(
+            "iocs_v3_ngrams", codec_options
+        )
+        self.IOCsV3NgramCounts = self[self._database].get_collection(
+            "iocs_v3_ngram_counts", codec_options
+        )
+        self.JobState = self[self._database].get_collection(
+            "job_state", codec_options
+        )
+        self.IOCSources = self[self._database].get_collection(
+            "ioc_sources", codec_options
+        )
+        self.GeoLocation = self[self._database].get_collection(
+            "location", codec_options
+        )
+        self.ASNRecords = self[self._database].get_collection(
+            "asn", codec_options
+        )
+        self.Networks = self[self._database].get_collection(
+            "network", codec_options
+        )
+        self.Organizations = self[self._database].get_collection(
+            "organization", codec_options
+        )
+
+
+class AppDB(DBConnection, AppCollections):
 
     # def __new__(cls):
     #     instance = super().__new__(cls)
@@ -35,34 +83,97 @@ class AppDB(DBConnection):
 
     def __init__(self):
         if not hasattr(self, "_app_initialized"):
-            super().__init__(env.APP_MONGO_URL, maxPoolSize=1)
-            self._database = env.APP_DB_NAME
-            self.IOCs = self[self._database].get_collection(
-                "iocs", codec_options
-            )
-            self.IOCsV2 = self[self._database].get_collection(
-                "iocs_v2", codec_options
-            )
-            self.IOCsV3 = self[self._database].get_collection(
-                "iocs_v3", codec_options
-            )
-            self.IOCsV3Cahe = self[self._database].get_collection(
-                "iocs_v3_cache", codec_options
-            )
-            self.IOCSources = self[self._database].get_collection(
-                "ioc_sources", codec_options
-            )
-            self.GeoLocation = self[self._database].get_collection(
-                "location", codec_options
-            )
-            self.ASNRecords = self[self._database].get_collection(
-                "asn", codec_options
-            )
-            self.Networks = self[self._database].get_collection(
-                "network", codec_options
-            )
-            self.Organizations = self[self._database].get_collection(
-                "organization", codec_options
-            )
+            super().__init__(env.APP_MONGO_URL, maxPoolSize=env.APP_MONGO_POOL_SIZE)
+            self._init_collections()
             self._app_initialized = True
 
+
+class AsyncAppDB(AsyncMongoClient, AppCollections):
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, "_app_initialized"):
+            super().__init__(env.APP_MONGO_URL, maxPoolSize=env.ASYNC_MONGO_POOL_SIZE)
+            self._init_collections()
+            self._app_initialized = True
+
+
+## indexes the queries in core rely on, keyed by AppCollections attribute
+INDEXES: Dict[str, List[IndexModel]] = {
+    "IOCs": [
+        *(IndexModel([(f"keys.{type_.value}", ASCENDING)]) for type_ in IOCType),
+        IndexModel([("ioc_types", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("created_at", DESCENDING)]),
+    ],
+    "IOCsV3": [IndexModel([("ioc", ASCENDING)])],
+    "IOCsV3Cahe": [
+        IndexModel([("first_found_at", DESCENDING)]),
+        IndexModel([("sources_ref.key", ASCENDING), ("first_found_at", DESCENDING)]),
+        IndexModel(
+            [("sources_ref.attr.threat_type", ASCENDING), ("first_found_at", DESCENDING)]
+        ),
+        IndexModel([("type_", ASCENDING), ("first_found_at", DESCENDING)]),
+    ],
+    "IOCsV3Counts": [
+        IndexModel([("dim", ASCENDING), ("value", ASCENDING), ("day", ASCENDING)], unique=True)
+    ],
+    "IOCsV3Ngrams": [IndexModel([("g", ASCENDING), ("ioc", ASCENDING)], unique=True)],
+    "IOCSources": [
+        IndexModel([("type", ASCENDING), ("key", ASCENDING)], unique=True),
+        ## the $lookup of ioc lookups joins on key alone
+        IndexModel([("key", ASCENDING)]),
+        IndexModel([("updated_at", DESCENDING)]),
+    ],
+    "GeoLocation": [IndexModel([("ipv4", ASCENDING)])],
+    "ASNRecords": [IndexModel([("ipv4", ASCENDING)])],
+    "Networks": [
+        IndexModel([("ip_version", ASCENDING), ("range_st", ASCENDING), ("range_en", ASCENDING)])
+    ],
+}
+
+
+## unique indexes added over data written before they existed, the oldest
+## document of each duplicate group is kept
+DEDUPE_BEFORE_INDEXING = {"IOCSources": ("type", "key")}
+
+
+def _dedupe(collection, keys) -> int:
+    groups = collection.aggregate(
+        [
+            {
+                "$group": {
+                    "_id": {k: f"${k}" for k in keys},
+                    "ids": {"$push": "$_id"},
+                    "n": {"$sum": 1},
+                }
+            },
+            {"$match": {"n": {"$gt": 1}}},
+        ],
+        allowDiskUse=True,
+    )
+    n_deleted = 0
+    for group in groups:
+        _, *dupes = sorted(group["ids"])
+        n_deleted += collection.delete_many({"_id": {"$in": dupes}}).deleted_count
+    return n_deleted
+
+
+def ensure_indexes() -> Dict[str, Dict]:
+    db = AppDB()
+    res = {}
+    ## one collection failing must not keep the others from being indexed
+    for name, indexes in INDEXES.items():
+        collection = getattr(db, name)
+        try:
+            res[name] = {}
+            if name in DEDUPE_BEFORE_INDEXING:
+                res[name]["deduped"] = _dedupe(collection, DEDUPE_BEFORE_INDEXING[name])
+            res[name]["indexes"] = collection.create_indexes(indexes)
+        except PyMongoError as e:
+            res[name]["error"] = str(e)
+    return res
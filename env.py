@@ -1,5 +1,6 @@
 import os
 import pytz
+from typing import Union
 from pytz.tzinfo import BaseTzInfo
 from pydantic import field_validator
 from pydantic_settings import BaseSettings
@@ -17,6 +18,20 @@ class Env(BaseSettings):
     NETFLOW_POSTGRES_URL: str
     FILES_DIR: str
     GOOGLE_CREDENTIALS_FILE: str
+    IPDR_INDEX_TTL: int = 300
+    GEO_SNAPSHOT_PATH: Union[str, None] = None
+    ASN_SNAPSHOT_PATH: Union[str, None] = None
+    ENRICHMENT_CACHE_SIZE: int = 100000
+    ENRICHMENT_CACHE_TTL: int = 600
+    NEGATIVE_CACHE_TTL: int = 60
+    SOURCE_REGISTRY_POLL_INTERVAL: int = 30
+    APP_MONGO_POOL_SIZE: int = 1
+    ASYNC_MONGO_POOL_SIZE: int = 50
+    BLACKLIST_FILTER_PATH: Union[str, None] = None
+    BLACKLIST_FILTER_CATCH_UP_INTERVAL: int = 60
+    BLACKLIST_FILTER_CATCH_UP_LAG: int = 300
+    BLACKLIST_FILTER_SAVE_INTERVAL: int = 600
+    NETFLOW_DIMENSIONS_POLL_INTERVAL: int = 30
 
     @field_validator("DEFAULT_TIME_ZONE", mode="before")
     def validate_time_zone(cls, value: str) -> BaseTzInfo:
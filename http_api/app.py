@@ -1,17 +1,39 @@
-from fastapi import FastAPI, HTTPException, APIRouter, Depends, Security
+from fastapi import FastAPI, HTTPException, APIRouter, Body, Depends, Header, Query, Security
 from fastapi.security import APIKeyHeader
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
+import threading
 from datetime import datetime
-from typing import Any, Dict, List, Union
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Literal, Union
 
 from enums import IOCType
-from utils import json_serializer
-from core import iocs, sources, geo, asn, netflow, client, ipdr
-from models import SortOrder
+from utils import json_dumps, ndjson_chunks, csv_chunks
+from core import iocs, sources, netflow, client, ipdr, async_client, bloom
+from models import IOCFinding, SortOrder
 from globals_ import env
 
+class APIResponse(Response):
+    media_type = "application/json"
+
+    ## serialized in a single pass, bypassing fastapi's jsonable_encoder
+    def render(self, content) -> bytes:
+        return json_dumps(content)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    ipdr.load_network_index()
+    threading.Thread(target=iocs.watch_ingestion, daemon=True).start()
+    bloom.load_blacklist_filter()
+    yield
+
+
 http_api = FastAPI(
-    docs_url=f"{env.API_PREFIX}/docs", openapi_url=f"{env.API_PREFIX}/openapi.json"
+    docs_url=f"{env.API_PREFIX}/docs",
+    openapi_url=f"{env.API_PREFIX}/openapi.json",
+    lifespan=lifespan,
+    default_response_class=APIResponse,
 )
 http_api.add_middleware(
     CORSMiddleware,
@@ -40,17 +62,19 @@ def api_key_auth():
 
 @router.post("/v1/get/iocs", dependencies=[Depends(api_key_auth())], tags=["IOC"])
 def _get_iocs(
-    page_no: int,
     per_page: int,
     type_: IOCType,
+    page_no: int = 1,
     filters: Dict[str, List] = {},
     sort_by: Union[str, None] = None,
     sort_order: SortOrder = "asc",
     date_from: datetime = None,
     date_to: datetime = None,
+    cursor: Union[str, None] = None,
+    fields: Union[List[str], None] = Query(None),
 ):
-    return json_serializer(
-        iocs.get_iocs(
+    try:
+        res = iocs.get_iocs(
             page=page_no,
             limit=per_page,
             filters=filters,
@@ -59,47 +83,94 @@ def _get_iocs(
             type_=type_,
             date_from=date_from,
             date_to=date_to,
+            cursor=cursor,
+            fields=fields,
         )
+    except ValueError as e:
+        raise HTTPException(detail=str(e), status_code=400)
+    return APIResponse(res)
+
+
+@router.post("/v1/export/iocs", dependencies=[Depends(api_key_auth())], tags=["IOC"])
+def _export_iocs(
+    type_: Union[IOCType, None] = None,
+    format_: Literal["ndjson", "csv"] = "ndjson",
+    filters: Dict[str, List] = {},
+    sort_by: Union[str, None] = None,
+    sort_order: SortOrder = "asc",
+    date_from: datetime = None,
+    date_to: datetime = None,
+):
+    findings = iocs.iter_iocs(
+        type_=type_,
+        filters=filters,
+        sort_by=sort_by,
+        sort_order=sort_order,
+        date_from=date_from,
+        date_to=date_to,
     )
+    if format_ == "csv":
+        fields = [f for f in IOCFinding.model_fields if f != "source_meta"]
+        return StreamingResponse(
+            csv_chunks(findings, fields),
+            media_type="text/csv",
+            headers={"Content-Disposition": 'attachment; filename="iocs.csv"'},
+        )
+    return StreamingResponse(ndjson_chunks(findings), media_type="application/x-ndjson")
 
 
 @router.get("/v1/get/location", dependencies=[Depends(api_key_auth())], tags=["IOC"])
-def _get_location(ip: str):
-    return json_serializer(geo.get_location(ip))
+async def _get_location(ip: str):
+    return APIResponse(await async_client.get_location(ip))
 
 
 @router.get("/v1/get/asn", dependencies=[Depends(api_key_auth())], tags=["IOC"])
-def _get_asn(ip: str):
-    return json_serializer(asn.get_asn_info(ip))
+async def _get_asn(ip: str):
+    return APIResponse(await async_client.get_asn_info(ip))
 
 
 @router.get("/v1/get/entity_info", dependencies=[Depends(api_key_auth())], tags=["IOC"])
-def _entity_info(type_: IOCType, val: Any):
-    return json_serializer(client.enrich_ioc(type_=type_, ioc=val))
+async def _entity_info(type_: IOCType, val: Any):
+    return APIResponse(await async_client.enrich_ioc(type_=type_, ioc=val))
+
+
+@router.post(
+    "/v1/get/entity_info/bulk", dependencies=[Depends(api_key_auth())], tags=["IOC"]
+)
+async def _entity_info_bulk(type_: IOCType, vals: List[str] = Body(...)):
+    return APIResponse(await async_client.enrich_iocs(type_=type_, iocs_=vals))
+
+
+@router.get("/v1/get/cache/stats", dependencies=[Depends(api_key_auth())], tags=["IOC"])
+def _get_cache_stats():
+    return client.cache_stats()
 
 
 @router.get(
     "/v1/get/ipdr_enrichment", dependencies=[Depends(api_key_auth())], tags=["IOC"]
 )
-def _get_viop(ip: str, port: Union[int, None] = None):
-    return json_serializer(client.get_ipdr_enrichment(ip=ip, port=port))
+async def _get_viop(ip: str, port: Union[int, None] = None):
+    return APIResponse(client.get_ipdr_enrichment(ip=ip, port=port))
 
 
 @router.post(
     "/v1/get/netflow", dependencies=[Depends(api_key_auth())], tags=["NETFLOW"]
 )
 def _get_netflow(
-    page_no: int,
     per_page: int,
+    page_no: int = 1,
     search_key: Dict[netflow.SearchableFields, str] = {},
     filters: Dict[str, List] = {},
     sort_by: Union[str, None] = None,
     sort_order: SortOrder = "asc",
     date_from: datetime = None,
     date_to: datetime = None,
+    fields: Union[List[str], None] = Query(None),
+    cursor: Union[str, None] = None,
+    exact_count: bool = False,
 ):
-    return json_serializer(
-        netflow.get_netflow(
+    try:
+        res = netflow.get_netflow(
             page=page_no,
             limit=per_page,
             search_key=search_key,
@@ -108,8 +179,13 @@ def _get_netflow(
             sort_order=sort_order,
             date_to=date_to,
             date_from=date_from,
+            fields=fields,
+            cursor=cursor,
+            exact_count=exact_count,
         )
-    )
+    except ValueError as e:
+        raise HTTPException(detail=str(e), status_code=400)
+    return APIResponse(res)
 
 
 @router.get(
@@ -117,23 +193,72 @@ def _get_netflow(
     dependencies=[Depends(api_key_auth())],
     tags=["NETFLOW"],
 )
-def _get_countries():
-    return netflow.get_unique_countries()
+def _get_countries(if_none_match: Union[str, None] = Header(None)):
+    etag, countries = netflow.get_unique_countries()
+    return _etag_response(etag, countries, if_none_match)
+
+
+@router.get(
+    "/v1/get/netflow/dimensions/{category}",
+    dependencies=[Depends(api_key_auth())],
+    tags=["NETFLOW"],
+)
+def _get_dimension_values(
+    category: netflow.DimensionCategory,
+    if_none_match: Union[str, None] = Header(None),
+):
+    etag, values = netflow.get_dimension_values(category)
+    return _etag_response(etag, values, if_none_match)
+
+
+def _etag_response(etag: Union[str, None], data, if_none_match: Union[str, None]):
+    if etag is None:
+        return APIResponse(data)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if if_none_match and etag in [
+        tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+    ]:
+        return Response(status_code=304, headers=headers)
+    return APIResponse(data, headers=headers)
+
+
+@router.get(
+    "/v1/get/netflow/frequency",
+    dependencies=[Depends(api_key_auth())],
+    tags=["NETFLOW"],
+)
+def _get_frequency_maps(
+    dimension: netflow.RollupDimension,
+    granularity: netflow.Granularity = "DAY",
+    date_from: datetime = None,
+    date_to: datetime = None,
+    limit: int = Query(10, ge=1, le=1000),
+):
+    return APIResponse(
+        netflow.get_frequency_maps(
+            dimension=dimension,
+            granularity=granularity,
+            date_from=date_from,
+            date_to=date_to,
+            limit=limit,
+        )
+    )
 
 
 @router.post("/v2/get/iocs", dependencies=[Depends(api_key_auth())], tags=["IOC"])
 def _get_iocs(
-    page_no: int,
     per_page: int,
+    page_no: int = 1,
     search_key: Union[str, None] = None,
     filters: Dict = {},
     sort_by: Union[str, None] = None,
     sort_order: SortOrder = "asc",
     date_from: datetime = None,
     date_to: datetime = None,
+    cursor: Union[str, None] = None,
 ):
-    return json_serializer(
-        iocs.get_iocs_v2(
+    try:
+        res = iocs.get_iocs_v2(
             page=page_no,
             limit=per_page,
             search_key=search_key,
@@ -142,29 +267,32 @@ def _get_iocs(
             sort_order=sort_order,
             date_from=date_from,
             date_to=date_to,
+            cursor=cursor,
         )
-    )
+    except ValueError as e:
+        raise HTTPException(detail=str(e), status_code=400)
+    return APIResponse(res)
 
 
 @router.get(
     "/v2/get/ioc_type/keys", dependencies=[Depends(api_key_auth())], tags=["IOC"]
 )
 def _get_iocs():
-    return json_serializer(iocs.get_type_keys())
+    return APIResponse(iocs.get_type_keys())
 
 
 @router.get(
     "/v2/get/ioc_source/keys", dependencies=[Depends(api_key_auth())], tags=["IOC"]
 )
 def _get_iocs():
-    return json_serializer(sources.get_source_keys())
+    return APIResponse(sources.get_source_keys())
 
 
 @router.get(
     "/v2/get/threat_type/keys", dependencies=[Depends(api_key_auth())], tags=["IOC"]
 )
 def _get_iocs():
-    return json_serializer(sources.get_threat_types())
+    return APIResponse(sources.get_threat_types())
 
 
 http_api.include_router(router)
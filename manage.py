@@ -0,0 +1,171 @@
+import sys
+import argparse
+from pprint import pprint
+
+import database
+from core import geo, asn, bloom, iocs, iocs_cache, ip_enrichment, ipdr, netflow, netflow_rollup, netflow_sync, ngrams, query_plans
+
+
+def _build_geo_snapshot(args):
+    pprint(geo.build_geo_snapshot(args.path))
+
+
+def _build_asn_snapshot(args):
+    pprint(asn.build_asn_snapshot(args.path))
+
+
+def _build_blacklist_filter(args):
+    pprint(bloom.build_blacklist_filter(args.path))
+
+
+def _enrich_netflow_ips(args):
+    pprint(ip_enrichment.enrich_netflow_ips(args.batch_size, args.workers))
+
+
+def _sync_typed_netflow(args):
+    pprint(netflow_sync.sync_typed_netflow(args.window_hours, args.lag_minutes))
+
+
+def _update_netflow_rollups(args):
+    pprint(netflow_rollup.update_netflow_rollups(args.batch_size))
+
+
+def _rebuild_netflow_dimensions(args):
+    pprint(netflow_rollup.rebuild_netflow_dimensions())
+
+
+def _create_netflow_search_indexes(args):
+    pprint(netflow.create_search_indexes())
+
+
+def _rebuild_ioc_counts(args):
+    pprint(iocs.rebuild_ioc_counts())
+
+
+def _update_iocs_cache(args):
+    if args.rebuild:
+        pprint(iocs_cache.rebuild_iocs_cache())
+    else:
+        pprint(iocs_cache.update_iocs_cache(args.batch_size, args.lag))
+
+
+def _rebuild_ioc_ngrams(args):
+    pprint(ngrams.rebuild_ioc_ngrams())
+
+
+def _migrate_network_ranges(args):
+    pprint(ipdr.migrate_network_ranges(args.batch_size))
+
+
+def _ensure_indexes(args):
+    res = database.ensure_indexes()
+    pprint(res)
+    if failed := [name for name, r in res.items() if "error" in r]:
+        print(f"could not index: {', '.join(failed)}")
+        return 1
+
+
+def _check_indexes(args):
+    database.ensure_indexes()
+    if args.seed:
+        query_plans.seed_collections()
+    res = query_plans.check_query_plans()
+    pprint(res)
+    if res["collscans"]:
+        print(f"collection scans in: {', '.join(res['collscans'])}")
+        return 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="manage.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser(
+        "build-geo-snapshot", help="export the location collection to a geo snapshot"
+    )
+    cmd.add_argument("--path", default=None)
+    cmd.set_defaults(func=_build_geo_snapshot)
+
+    cmd = commands.add_parser(
+        "build-asn-snapshot", help="materialize the asn collection to an asn snapshot"
+    )
+    cmd.add_argument("--path", default=None)
+    cmd.set_defaults(func=_build_asn_snapshot)
+
+    cmd = commands.add_parser(
+        "build-blacklist-filter", help="build the per ioc type blacklist bloom filters"
+    )
+    cmd.add_argument("--path", default=None)
+    cmd.set_defaults(func=_build_blacklist_filter)
+
+    cmd = commands.add_parser(
+        "enrich-netflow-ips", help="fill ip_enrichment for netflow ips not enriched yet"
+    )
+    cmd.add_argument("--batch-size", type=int, default=5000)
+    cmd.add_argument("--workers", type=int, default=4)
+    cmd.set_defaults(func=_enrich_netflow_ips)
+
+    cmd = commands.add_parser(
+        "sync-typed-netflow", help="copy new refined_netflow rows into netflow_typed"
+    )
+    cmd.add_argument("--window-hours", type=int, default=24)
+    cmd.add_argument("--lag-minutes", type=int, default=60)
+    cmd.set_defaults(func=_sync_typed_netflow)
+
+    cmd = commands.add_parser(
+        "update-netflow-rollups", help="fold new netflow_typed rows into netflow_rollup"
+    )
+    cmd.add_argument("--batch-size", type=int, default=1000000)
+    cmd.set_defaults(func=_update_netflow_rollups)
+
+    cmd = commands.add_parser(
+        "rebuild-netflow-dimensions",
+        help="refill netflow_dimension from the rolled up netflow_typed rows",
+    )
+    cmd.set_defaults(func=_rebuild_netflow_dimensions)
+
+    cmd = commands.add_parser(
+        "create-netflow-search-indexes",
+        help="create the trigram and equality indexes behind the netflow search",
+    )
+    cmd.set_defaults(func=_create_netflow_search_indexes)
+
+    cmd = commands.add_parser(
+        "rebuild-ioc-counts", help="recount the v2 ioc listing counters from iocs_v3_cache"
+    )
+    cmd.set_defaults(func=_rebuild_ioc_counts)
+
+    cmd = commands.add_parser(
+        "update-iocs-cache", help="merge iocs_v3 findings newer than the watermark into iocs_v3_cache"
+    )
+    cmd.add_argument("--batch-size", type=int, default=50000)
+    cmd.add_argument("--lag", type=int, default=60, help="seconds to leave unsettled inserts alone")
+    cmd.add_argument("--rebuild", action="store_true", help="regroup the whole collection instead")
+    cmd.set_defaults(func=_update_iocs_cache)
+
+    cmd = commands.add_parser(
+        "rebuild-ioc-ngrams", help="rebuild the trigram postings used by the v2 search_key"
+    )
+    cmd.set_defaults(func=_rebuild_ioc_ngrams)
+
+    cmd = commands.add_parser(
+        "migrate-network-ranges", help="add numeric range bounds to network documents"
+    )
+    cmd.add_argument("--batch-size", type=int, default=1000)
+    cmd.set_defaults(func=_migrate_network_ranges)
+
+    cmd = commands.add_parser("ensure-indexes", help="create the indexes declared in database.INDEXES")
+    cmd.set_defaults(func=_ensure_indexes)
+
+    cmd = commands.add_parser(
+        "check-indexes", help="explain the canonical core queries and fail on collection scans"
+    )
+    cmd.add_argument("--seed", action="store_true", help="insert sample docs into empty collections")
+    cmd.set_defaults(func=_check_indexes)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,10 @@
+import ipaddress
+from enum import Enum
 from pydantic import BaseModel, Field
 from pydantic_core import core_schema
 from datetime import datetime
-from typing import List, Dict, Any, Union, Mapping, Literal, Annotated
+from typing import List, Dict, Any, Callable, Union, Mapping, Literal, Annotated
+from typing import get_args, get_origin
 from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network
 
 from enums import IOCType, SourceType, Lang
@@ -36,6 +39,57 @@ class Model(BaseModel):
 
     model_config = {"populate_by_name": True}
 
+    @classmethod
+    def from_trusted(cls, data: Mapping):
+        ## for documents read back from our own collections, coerces the
+        ## stored representation without running validation
+        converters = _trusted_converters.get(cls)
+        if converters is None:
+            converters = _trusted_converters[cls] = {
+                field.alias or name: _converter(field.annotation)
+                for name, field in cls.model_fields.items()
+            }
+        values = {}
+        for key, convert in converters.items():
+            if key in data:
+                val = data[key]
+                values[key] = val if convert is None or val is None else convert(val)
+        return cls.model_construct(**values)
+
+
+_trusted_converters: Dict[type, Dict[str, Callable | None]] = {}
+
+
+def _converter(annotation) -> Callable | None:
+    origin, args = get_origin(annotation), get_args(annotation)
+    if origin is Union:
+        args = [a for a in args if a is not type(None)]
+        if set(args) <= {IPv4Network, IPv6Network}:
+            return ipaddress.ip_network
+        if set(args) <= {IPv4Address, IPv6Address}:
+            return ipaddress.ip_address
+        if len(args) == 1:
+            return _converter(args[0])
+        return None
+    if origin in (list, List):
+        convert = _converter(args[0]) if args else None
+        return None if convert is None else lambda vals: [convert(v) for v in vals]
+    if origin in (dict, Dict):
+        convert_k, convert_v = (_converter(a) for a in args) if args else (None, None)
+        if convert_k is None and convert_v is None:
+            return None
+        convert_k = convert_k or (lambda k: k)
+        convert_v = convert_v or (lambda v: v)
+        return lambda vals: {convert_k(k): convert_v(v) for k, v in vals.items()}
+    if isinstance(annotation, type):
+        if issubclass(annotation, Model):
+            return annotation.from_trusted
+        if issubclass(annotation, Enum):
+            return annotation
+        if annotation is Names:
+            return Names.validate
+    return None
+
 
 class Source(Model):
     id: str
@@ -43,6 +97,7 @@ class Source(Model):
     key: str
     # url: str
     created_at: datetime
+    updated_at: Union[datetime, None] = None
     attribution: Dict = {}
 
 
@@ -171,6 +226,11 @@ class Network(Model):
     # hosts: List[str]
     network_st: str
     network_en: str
+    ## numeric bounds, Int64 for IPv4 and 16 byte big endian for IPv6
+    ip_version: Union[int, None] = None
+    range_st: Union[int, bytes, None] = None
+    range_en: Union[int, bytes, None] = None
+    prefixlen: Union[int, None] = None
     belongs_to: Union[OrgRef, None] = None
 
 
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Text, Boolean, Numeric, DateTime, ARRAY, Uuid
+from sqlalchemy import Column, Text, Boolean, Numeric, DateTime, ARRAY, Uuid, BigInteger, Identity, Index
+from sqlalchemy.dialects.postgresql import INET
 from globals_ import sql_Base
 
 class IpEnrichment(sql_Base):
@@ -128,3 +129,147 @@ class NetFlow(sql_Base):
     packet_size_category = Column(Text())
     tcp_flags_text = Column(Text())
     flow_duration_seconds = Column(Text())
+
+
+class TypedNetFlow(sql_Base):
+    ## refined_netflow with native column types, filled by core.netflow_sync
+    __tablename__ = "netflow_typed"
+    __table_args__ = (
+        Index("ix_netflow_typed_start", "flow_start_timestamp", "id"),
+        Index(
+            "ix_netflow_typed_src_addr",
+            "ipv4_src_addr",
+            postgresql_using="gist",
+            postgresql_ops={"ipv4_src_addr": "inet_ops"},
+        ),
+        Index(
+            "ix_netflow_typed_dst_addr",
+            "ipv4_dst_addr",
+            postgresql_using="gist",
+            postgresql_ops={"ipv4_dst_addr": "inet_ops"},
+        ),
+    )
+    id = Column(Uuid(), primary_key=True)
+    seq = Column(BigInteger(), Identity(), unique=True, nullable=False)
+    flow_start_milliseconds = Column(BigInteger())
+    flow_end_milliseconds = Column(BigInteger())
+    ipv4_src_addr = Column(INET())
+    l4_src_port = Column(BigInteger())
+    ipv4_dst_addr = Column(INET())
+    l4_dst_port = Column(BigInteger())
+    protocol = Column(BigInteger())
+    l7_proto = Column(Text())
+    in_bytes = Column(BigInteger())
+    in_pkts = Column(BigInteger())
+    out_bytes = Column(BigInteger())
+    out_pkts = Column(BigInteger())
+    tcp_flags = Column(BigInteger())
+    client_tcp_flags = Column(BigInteger())
+    server_tcp_flags = Column(BigInteger())
+    flow_duration_milliseconds = Column(BigInteger())
+    duration_in = Column(BigInteger())
+    duration_out = Column(BigInteger())
+    min_ttl = Column(BigInteger())
+    max_ttl = Column(BigInteger())
+    longest_flow_pkt = Column(BigInteger())
+    shortest_flow_pkt = Column(BigInteger())
+    min_ip_pkt_len = Column(BigInteger())
+    max_ip_pkt_len = Column(BigInteger())
+    src_to_dst_second_bytes = Column(Numeric())
+    dst_to_src_second_bytes = Column(Numeric())
+    retransmitted_in_bytes = Column(BigInteger())
+    retransmitted_in_pkts = Column(BigInteger())
+    retransmitted_out_bytes = Column(BigInteger())
+    retransmitted_out_pkts = Column(BigInteger())
+    src_to_dst_avg_throughput = Column(Numeric())
+    dst_to_src_avg_throughput = Column(Numeric())
+    num_pkts_up_to_128_bytes = Column(BigInteger())
+    num_pkts_128_to_256_bytes = Column(BigInteger())
+    num_pkts_256_to_512_bytes = Column(BigInteger())
+    num_pkts_512_to_1024_bytes = Column(BigInteger())
+    num_pkts_1024_to_1514_bytes = Column(BigInteger())
+    tcp_win_max_in = Column(BigInteger())
+    tcp_win_max_out = Column(BigInteger())
+    icmp_type = Column(BigInteger())
+    icmp_ipv4_type = Column(BigInteger())
+    dns_query_id = Column(BigInteger())
+    dns_query_type = Column(BigInteger())
+    dns_ttl_answer = Column(BigInteger())
+    ftp_command_ret_code = Column(BigInteger())
+    src_to_dst_iat_min = Column(Numeric())
+    src_to_dst_iat_max = Column(Numeric())
+    src_to_dst_iat_avg = Column(Numeric())
+    src_to_dst_iat_stddev = Column(Numeric())
+    dst_to_src_iat_min = Column(Numeric())
+    dst_to_src_iat_max = Column(Numeric())
+    dst_to_src_iat_avg = Column(Numeric())
+    dst_to_src_iat_stddev = Column(Numeric())
+    label = Column(Text())
+    attack = Column(Text())
+    src_country = Column(Text())
+    src_region = Column(Text())
+    src_lat = Column(Numeric())
+    src_long = Column(Numeric())
+    src_asn = Column(Text())
+    src_organization_name = Column(Text())
+    src_domain_name = Column(Text())
+    src_entity_type = Column(Text())
+    src_tor = Column(Boolean())
+    src_proxy = Column(Boolean())
+    src_vpn = Column(Boolean())
+    src_hosting = Column(Boolean())
+    src_relay = Column(Boolean())
+    src_service = Column(Boolean())
+    src_blacklisted = Column(Boolean())
+    src_region_code = Column(Text())
+    dest_country = Column(Text())
+    dest_region = Column(Text())
+    dest_lat = Column(Numeric())
+    dest_long = Column(Numeric())
+    dest_asn = Column(Text())
+    dest_organization_name = Column(Text())
+    dest_domain_name = Column(Text())
+    dest_entity_type = Column(Text())
+    dest_tor = Column(Boolean())
+    dest_proxy = Column(Boolean())
+    dest_vpn = Column(Boolean())
+    dest_hosting = Column(Boolean())
+    dest_relay = Column(Boolean())
+    dest_service = Column(Boolean())
+    dest_blacklisted = Column(Boolean())
+    dest_region_code = Column(Text())
+    protocol_name = Column(Text())
+    application = Column(Text())
+    flow_direction = Column(Text())
+    is_suspicious = Column(Boolean())
+    flow_start_timestamp = Column(DateTime(timezone=True))
+    flow_end_timestamp = Column(DateTime(timezone=True))
+    src_to_dst_throughput_mbps = Column(Numeric())
+    dst_to_src_throughput_mbps = Column(Numeric())
+    packet_size_category = Column(Text())
+    tcp_flags_text = Column(Text())
+    flow_duration_seconds = Column(Numeric())
+
+
+class NetflowRollup(sql_Base):
+    __tablename__ = "netflow_rollup"
+    granularity = Column(Text(), primary_key=True)
+    dimension = Column(Text(), primary_key=True)
+    bucket = Column(DateTime(timezone=True), primary_key=True)
+    value = Column(Text(), primary_key=True)
+    bytes = Column(Numeric(), nullable=False, default=0)
+    packets = Column(Numeric(), nullable=False, default=0)
+    flows = Column(BigInteger(), nullable=False, default=0)
+
+
+class NetflowDimension(sql_Base):
+    __tablename__ = "netflow_dimension"
+    category = Column(Text(), primary_key=True)
+    value = Column(Text(), primary_key=True)
+
+
+class JobWatermark(sql_Base):
+    __tablename__ = "job_watermark"
+    job = Column(Text(), primary_key=True)
+    value = Column(Text(), nullable=True)
+    updated_at = Column(DateTime(timezone=True), nullable=True)
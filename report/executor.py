@@ -31,7 +31,7 @@ from .enums import get_model, get_slice
 from utils import json_serializer, csv_serializer, mongo_serializer, curr_time, date_from_datetime, ID
 
 from globals_ import env, default_google_conn
-from core.iocs import get_iocs
+from core.iocs import iter_iocs
 from enums import IOCType
 
 def evaluate_template_string(
@@ -304,12 +304,12 @@ class ReportGenerator:
                     curr = date_from_datetime(curr_time())
                     yestr_day_st = curr-timedelta(days=1)
                     yestr_day_en = curr-timedelta(minutes=1)
-                    data = get_iocs(page=1, limit=10**9, date_from=yestr_day_st, date_to=yestr_day_en)
-                    data = data["data"]
+                    data = iter_iocs(date_from=yestr_day_st, date_to=yestr_day_en)
                 else:
                     data = []
-                data_to_update = data
             model_data = [data_slice_type_._model_type(d) for d in data]
+            if data_slice_type_ == get_slice(ReportDataSlice.IOCFindingDataSlice):
+                data_to_update = model_data
             self._data_slices[ds.name] = data_slice_type_(model_data)
         print(len(data_to_update))
         ## generation of items in the report
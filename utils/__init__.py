@@ -1,10 +1,16 @@
+import io
 import re
+import csv
 import json
 import uuid
+import base64
+import orjson
 from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network
-from bson import ObjectId
+from bson import ObjectId, json_util
 from datetime import datetime
+from decimal import Decimal
 from enum import Enum
+from typing import Callable, Dict, Iterable, Iterator, List
 from pytz import timezone
 from pydantic import BaseModel
 
@@ -47,71 +53,121 @@ def sql_base_serializer(obj: sql_Base):  # type: ignore
     return {c.name: getattr(obj, c.name) for c in obj.__table__.columns}
 
 
-def mongo_serializer(obj):
-    func_ = mongo_serializer
-    if isinstance(obj, IPv4Address) or isinstance(obj, IPv4Network) or isinstance(obj, IPv6Address) or isinstance(obj, IPv6Network):
-        return str(obj)
-    if isinstance(obj, sql_Base):
-        return func_(sql_base_serializer(obj))
-    if isinstance(obj, uuid.UUID):
-        return str(obj)
-    if isinstance(obj, datetime):
-        return to_utc(obj)
-    if isinstance(obj, Enum):
-        return obj.value
-    if isinstance(obj, BaseModel):
-        return func_(vars(obj))
-    if isinstance(obj, list):
-        return [func_(e) for e in obj]
-    if isinstance(obj, dict):
-        return {func_(k): func_(v) for k, v in obj.items()}
-    return obj
-
-
-def json_serializer(obj):
-    func_ = json_serializer
-    if isinstance(obj, IPv4Address) or isinstance(obj, IPv4Network) or isinstance(obj, IPv6Address) or isinstance(obj, IPv6Network):
-        return str(obj)
-    if isinstance(obj, sql_Base):
-        return func_(sql_base_serializer(obj))
-    if isinstance(obj, uuid.UUID):
-        return str(obj)
-    if isinstance(obj, ObjectId):
-        return str(obj)
-    if isinstance(obj, datetime):
-        return obj.isoformat()
-    if isinstance(obj, Enum):
-        return obj.value
-    if isinstance(obj, BaseModel):
-        return func_(vars(obj))
-    if isinstance(obj, list):
-        return [func_(e) for e in obj]
-    if isinstance(obj, dict):
-        return {func_(k): func_(v) for k, v in obj.items()}
-    return obj
-
-
-def csv_serializer(obj):
-    func_ = csv_serializer
-    if isinstance(obj, IPv4Address) or isinstance(obj, IPv4Network) or isinstance(obj, IPv6Address) or isinstance(obj, IPv6Network):
-        return str(obj)
-    if isinstance(obj, sql_Base):
-        return func_(sql_base_serializer(obj))
-    if isinstance(obj, uuid.UUID):
-        return str(obj)
-    if isinstance(obj, ObjectId):
-        return str(obj)
-    if isinstance(obj, datetime):
-        return obj.isoformat()
-    if isinstance(obj, Enum):
-        return obj.value
-    if isinstance(obj, BaseModel):
-        return func_(vars(obj))
-    if isinstance(obj, list):
-        return ", ".join([func_(e) for e in obj])
-    if isinstance(obj, dict):
-        return json.dumps({func_(k): func_(v) for k, v in obj.items()})
-    return obj
+IP_TYPES = (IPv4Address, IPv4Network, IPv6Address, IPv6Network)
+
+
+def _type_dispatch(handlers: Dict[type, Callable]) -> Callable[[type], Callable | None]:
+    ## resolves a handler along the mro once per concrete type
+    resolved = {}
+
+    def handler_for(cls: type):
+        try:
+            return resolved[cls]
+        except KeyError:
+            handler = next((handlers[c] for c in cls.__mro__ if c in handlers), None)
+            resolved[cls] = handler
+            return handler
+
+    return handler_for
+
+
+def _serializer(handlers: Dict[type, Callable]) -> Callable:
+    handler_for = _type_dispatch(handlers)
+
+    def serialize(obj):
+        handler = handler_for(type(obj))
+        return obj if handler is None else handler(obj, serialize)
+
+    return serialize
+
+
+_common_handlers = {
+    **{t: lambda obj, _: str(obj) for t in IP_TYPES},
+    sql_Base: lambda obj, func_: func_(sql_base_serializer(obj)),
+    uuid.UUID: lambda obj, _: str(obj),
+    Enum: lambda obj, _: obj.value,
+    BaseModel: lambda obj, func_: func_(vars(obj)),
+    list: lambda obj, func_: [func_(e) for e in obj],
+    dict: lambda obj, func_: {func_(k): func_(v) for k, v in obj.items()},
+}
+
+mongo_serializer = _serializer(
+    {
+        **_common_handlers,
+        datetime: lambda obj, _: to_utc(obj),
+    }
+)
+
+json_serializer = _serializer(
+    {
+        **_common_handlers,
+        ObjectId: lambda obj, _: str(obj),
+        datetime: lambda obj, _: obj.isoformat(),
+        bytes: lambda obj, _: obj.hex(),
+    }
+)
+
+csv_serializer = _serializer(
+    {
+        **_common_handlers,
+        ObjectId: lambda obj, _: str(obj),
+        datetime: lambda obj, _: obj.isoformat(),
+        bytes: lambda obj, _: obj.hex(),
+        list: lambda obj, func_: ", ".join([func_(e) for e in obj]),
+        dict: lambda obj, func_: json.dumps({func_(k): func_(v) for k, v in obj.items()}),
+    }
+)
+
+## orjson handles str, numbers, datetime, uuid, enums, lists and dicts
+## itself and only calls back for the rest
+_orjson_handler_for = _type_dispatch(
+    {
+        **{t: str for t in IP_TYPES},
+        ObjectId: str,
+        sql_Base: sql_base_serializer,
+        BaseModel: vars,
+        bytes: bytes.hex,
+        Decimal: lambda obj: int(obj) if obj == obj.to_integral_value() else float(obj),
+        set: list,
+        frozenset: list,
+    }
+)
+
+
+def orjson_default(obj):
+    handler = _orjson_handler_for(type(obj))
+    if handler is None:
+        e = f"{type(obj).__name__} is not serializable"
+        raise TypeError(e)
+    return handler(obj)
+
+
+def json_dumps(obj) -> bytes:
+    return orjson.dumps(obj, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def ndjson_chunks(rows: Iterable, chunk_size: int = 1000) -> Iterator[bytes]:
+    chunk = []
+    for row in rows:
+        chunk.append(json_dumps(row))
+        if len(chunk) >= chunk_size:
+            yield b"\n".join(chunk) + b"\n"
+            chunk = []
+    if chunk:
+        yield b"\n".join(chunk) + b"\n"
+
+
+def csv_chunks(rows: Iterable, fields: List[str], chunk_size: int = 1000) -> Iterator[str]:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(fields)
+    for i, row in enumerate(rows, 1):
+        writer.writerow([csv_serializer(row[f]) for f in fields])
+        if i % chunk_size == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
 
 
 def timezone_updater(obj, tz):
@@ -139,3 +195,21 @@ def if_null(*args):
     for arg in args:
         if not arg:
             return arg
+
+
+def encode_cursor(obj: dict) -> str:
+    return base64.urlsafe_b64encode(json_util.dumps(obj).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> dict:
+    e = "invalid cursor"
+    try:
+        obj = json_util.loads(
+            base64.urlsafe_b64decode(cursor.encode("ascii")),
+            json_options=json_util.JSONOptions(tz_aware=True),
+        )
+    except ValueError:
+        raise ValueError(e)
+    if not isinstance(obj, dict) or not isinstance(obj.get("values"), list):
+        raise ValueError(e)
+    return obj